@@ -0,0 +1,198 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import platform
+import numpy as np
+from datetime import datetime
+from cache import source_key
+
+## bumped whenever the layout of the manifest or the arrays changes
+FORMAT_VERSION = 3
+
+class ArtifactError(ValueError):
+    """
+    A model artifact is missing, corrupt, of another format version or
+    older than the files it was built from.
+    """
+
+def file_checksum(path, block_size=1 << 20):
+    """
+    SHA-1 of the content of a file.
+    """
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def quick_checksum(path, block_size=1 << 16):
+    """
+    SHA-1 of the first and last block of a file (the .npy header and the
+    end of the buffer), cheap enough to check on every load.
+    """
+    size = os.path.getsize(path)
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        h.update(f.read(block_size))
+        if size > block_size:
+            f.seek(max(size - block_size, block_size))
+            h.update(f.read())
+    return h.hexdigest()
+
+def manifest_checksum(manifest):
+    """
+    SHA-1 of every manifest entry but the checksum itself.
+    """
+    content = dict((k, v) for k, v in manifest.items() if k != "checksum")
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+def library_versions():
+    versions = {"python": platform.python_version(), "numpy": np.__version__}
+    try:
+        import sklearn
+        versions["sklearn"] = sklearn.__version__
+    except ImportError:
+        versions["sklearn"] = None
+    return versions
+
+def save_artifact(directory, arrays, feature_names=None, sources=(), meta=None):
+    """
+    Write named arrays as a versioned model artifact.
+
+    The artifact is a directory with one raw .npy buffer per array and a
+    manifest.json holding the format version, library versions, feature
+    names, the size and modification time of the files the model was built
+    from, the size, SHA-1 and quick_checksum() of every buffer and a
+    checksum of the manifest.
+    It is written to a temporary directory first and moved in place, so an
+    interrupted run never leaves a half artifact.
+
+    Args:
+        directory: artifact directory (replaced if it exists).
+        arrays: dict of name to array (no object arrays).
+        feature_names: feature names of the model's input columns, in order.
+        sources: paths of the files the model was built from (e.g. the pickles).
+        meta: other json-serializable values (e.g. output names).
+
+    Returns:
+        the manifest.
+    """
+    tmp_directory = directory.rstrip("/") + ".tmp"
+    if os.path.exists(tmp_directory):
+        shutil.rmtree(tmp_directory)
+    os.makedirs(tmp_directory)
+    entries = []
+    for name in sorted(arrays):
+        values = np.ascontiguousarray(arrays[name])
+        if values.dtype == object:
+            raise ArtifactError("array '{}' has dtype object".format(name))
+        file_name = name + ".npy"
+        path = os.path.join(tmp_directory, file_name)
+        np.save(path, values, allow_pickle=False)
+        entries.append({"name": name, "file": file_name, "dtype": str(values.dtype), "shape": list(values.shape),
+            "bytes": os.path.getsize(path), "sha1": file_checksum(path), "quick_sha1": quick_checksum(path)})
+    manifest = {"format_version": FORMAT_VERSION, "created": datetime.now().isoformat(),
+        "versions": library_versions(), "feature_names": list(feature_names) if feature_names is not None else None,
+        "sources": dict((path, source_key(path)) for path in sources),
+        "meta": meta or {}, "arrays": entries}
+    manifest["checksum"] = manifest_checksum(manifest)
+    with open(os.path.join(tmp_directory, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.rename(tmp_directory, directory)
+    return manifest
+
+def read_manifest(directory):
+    """
+    Read and check the manifest of an artifact written by save_artifact().
+    """
+    path = os.path.join(directory, "manifest.json")
+    if not os.path.exists(path):
+        raise ArtifactError("no model artifact at {}".format(directory))
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise ArtifactError("{} has format version {}, expected {}".format(directory,
+            manifest.get("format_version"), FORMAT_VERSION))
+    if manifest.get("checksum") != manifest_checksum(manifest):
+        raise ArtifactError("the manifest of {} is corrupt".format(directory))
+    return manifest
+
+def stale_sources(manifest):
+    """
+    Source files of an artifact that changed since it was built. Missing
+    sources are not reported, so artifacts can be deployed on their own.
+    """
+    return [path for path, key in sorted(manifest["sources"].items())
+        if os.path.exists(path) and source_key(path) != key]
+
+def load_artifact(directory, mmap=True, verify=False, feature_names=None, check_sources=True):
+    """
+    Load the arrays of an artifact written by save_artifact().
+
+    Only the manifest is parsed and the size and quick_checksum() of
+    every buffer checked; the buffers are memory-mapped read-only, so
+    loading takes milliseconds and scoring processes on one machine share
+    the pages of the same artifact.
+
+    Args:
+        directory: artifact directory.
+        mmap: memory-map the buffers instead of reading them.
+        verify: also check the SHA-1 of the whole of every buffer (reads
+            all of them).
+        feature_names: if given, the feature names the caller will score
+            with; they must match the ones the artifact was built with.
+        check_sources: fail if a source file changed since the artifact
+            was built.
+
+    Returns:
+        (dict of name to array, manifest).
+
+    Raises:
+        ArtifactError: the artifact is missing, corrupt, of another format
+            version, built for other features or older than its sources.
+    """
+    manifest = read_manifest(directory)
+    if feature_names is not None and manifest["feature_names"] is not None \
+            and list(feature_names) != manifest["feature_names"]:
+        raise ArtifactError("{} was built for other features than the transformer's".format(directory))
+    if check_sources:
+        stale = stale_sources(manifest)
+        if stale:
+            raise ArtifactError("{} is stale, rebuild it: {} changed since".format(directory, ", ".join(stale)))
+    arrays = {}
+    for entry in manifest["arrays"]:
+        path = os.path.join(directory, entry["file"])
+        if not os.path.exists(path) or os.path.getsize(path) != entry["bytes"]:
+            raise ArtifactError("{} is missing or truncated".format(path))
+        if quick_checksum(path) != entry["quick_sha1"] or (verify and file_checksum(path) != entry["sha1"]):
+            raise ArtifactError("{} fails its checksum".format(path))
+        values = np.load(path, mmap_mode="r" if mmap else None, allow_pickle=False)
+        if str(values.dtype) != entry["dtype"] or list(values.shape) != entry["shape"]:
+            raise ArtifactError("{} does not match the manifest".format(path))
+        arrays[entry["name"]] = values
+    return arrays, manifest
+
+def main():
+    """
+    Verify the artifacts given as arguments, buffers included.
+    """
+    failed = False
+    for directory in sys.argv[1:]:
+        try:
+            arrays, manifest = load_artifact(directory, mmap=True, verify=True)
+        except ArtifactError as e:
+            print("FAILED {}".format(e))
+            failed = True
+            continue
+        print("OK {}: format {}, created {}, {} arrays, {:.1f} MB, {}".format(directory, manifest["format_version"],
+            manifest["created"], len(arrays), sum(e["bytes"] for e in manifest["arrays"]) / 1e6,
+            ", ".join("{} {}".format(k, v) for k, v in sorted(manifest["versions"].items()))))
+    if failed:
+        sys.exit(1)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,189 @@
+import data_import
+import compiled_model
+import evaluate
+import profiling
+import serve
+import synth
+import tuning
+import os
+import sys
+import json
+import argparse
+import numpy as np
+from collections import OrderedDict
+from features import feature_eng
+from sklearn.ensemble import RandomForestClassifier, GradientBoostingClassifier, ExtraTreesClassifier, VotingClassifier
+
+## timed stages, in pipeline order
+STAGES = ["load_train", "load_test", "feature_eng", "transform_test", "train",
+    "predict_proba", "compile", "serve_sklearn", "serve_compiled", "write_submission", "ndcg"]
+
+## test searches scored one at a time, as serve.py does
+SERVE_SEARCHES = 500
+
+def benchmark_model(n_jobs=1):
+    """
+    The voting ensemble of train.py with fixed mid-range parameters, so
+    the timings do not depend on the hyperparameter search.
+    """
+    return VotingClassifier(estimators=[
+            ('rf', RandomForestClassifier(n_estimators=50, max_depth=8, min_samples_leaf=5,
+                max_features='sqrt', min_samples_split=4, random_state=42, n_jobs=n_jobs)),
+            ('gbm', GradientBoostingClassifier(n_estimators=100, max_depth=4, min_samples_leaf=5,
+                learning_rate=0.0008, loss='exponential', min_samples_split=3, max_features='sqrt', random_state=42)),
+            ('et', ExtraTreesClassifier(n_estimators=50, max_depth=8, min_samples_leaf=5,
+                max_features='sqrt', criterion='entropy', random_state=42, n_jobs=n_jobs))],
+        voting='soft', weights=[3,5,2])
+
+def run(n_rows, directory=None, n_jobs=1):
+    """
+    Time the pipeline stages on synthetic data of a given size.
+
+    The synthetic files are generated on first use. Models are fitted on
+    80% of the training searches and nDCG@38 is measured on the rest.
+
+    Args:
+        n_rows: the number of rows of the synthetic train and test files.
+        directory: directory of the synthetic files (SETTINGS.json if None).
+        n_jobs: the number of jobs of the forests.
+
+    Returns:
+        dict with the per-stage wall/cpu time, RSS (at the end, growth,
+        peak) and rows/sec, the
+        holdout nDCG@38 and the largest difference between the sklearn and
+        compiled scores of single searches.
+    """
+    train_path, test_path = synth.synthetic_paths(n_rows, directory)
+    if not os.path.exists(train_path) or not os.path.exists(test_path):
+        print("Generating {} synthetic rows...".format(n_rows))
+        synth.write_csv(train_path, n_rows, test=False, random_state=1)
+        synth.write_csv(test_path, n_rows, test=True, random_state=2)
+
+    profiler = profiling.Profiler(verbose=False)
+    with profiler.stage("load_train") as span:
+        train = data_import.read_compact(train_path)
+        span.rows = len(train)
+    with profiler.stage("load_test") as span:
+        test = data_import.read_compact(test_path)
+        span.rows = len(test)
+    with profiler.stage("feature_eng") as span:
+        transformer = feature_eng(train)
+        span.rows = len(train)
+    with profiler.stage("transform_test") as span:
+        transformer.transform(test)
+        span.rows = len(test)
+
+    fit_part, holdout = evaluate.holdout_split(train)
+    X_fit, X_holdout, X_test = transformer.matrix(fit_part), transformer.matrix(holdout), transformer.matrix(test)
+    rng = np.random.RandomState(42)
+    models = {}
+    with profiler.stage("train") as span:
+        span.rows = 0
+        for outcome in ["booking_bool", "click_bool"]:
+            y = fit_part[outcome].values
+            rows = tuning.balanced_indices(y, np.arange(len(y)), rng)
+            models[outcome] = benchmark_model(n_jobs).fit(X_fit[rows], y[rows])
+            span.rows += len(rows)
+
+    with profiler.stage("predict_proba") as span:
+        scores = -(4 * models["booking_bool"].predict_proba(X_test)[:,1] + models["click_bool"].predict_proba(X_test)[:,1])
+        span.rows = len(test)
+
+    ## single searches in the calling thread, with sklearn and with the compiled artifact of serve.py
+    with profiler.stage("compile"):
+        compiled = compiled_model.CompiledEnsemble([models["booking_bool"], models["click_bool"]], ["book", "click"])
+    searches = np.split(np.arange(len(test)), np.flatnonzero(np.diff(test["srch_id"].values)) + 1)[:SERVE_SEARCHES]
+    book, click = serve.single_threaded(models["booking_bool"]), serve.single_threaded(models["click_bool"])
+    with profiler.stage("serve_sklearn") as span:
+        sklearn_scores = [4 * book.predict_proba(X_test[rows])[:,1] + click.predict_proba(X_test[rows])[:,1] for rows in searches]
+        span.rows = sum(len(rows) for rows in searches)
+    with profiler.stage("serve_compiled") as span:
+        compiled_scores = [np.dot(compiled.predict_proba(X_test[rows]), [4, 1]) for rows in searches]
+        span.rows = sum(len(rows) for rows in searches)
+
+    submission_path = os.path.join(os.path.dirname(test_path), "submission_{}.csv".format(n_rows))
+    with profiler.stage("write_submission") as span:
+        with data_import.SubmissionWriter(submission_path) as writer:
+            writer.write(test["srch_id"].values, test["prop_id"].values, scores, grouped=True)
+        span.rows = len(test)
+
+    holdout_scores = 4 * models["booking_bool"].predict_proba(X_holdout)[:,1] + models["click_bool"].predict_proba(X_holdout)[:,1]
+    with profiler.stage("ndcg") as span:
+        ndcg = evaluate.evaluate_frame(holdout, holdout_scores)
+        span.rows = len(holdout)
+
+    stages = profiler.summary()
+    result = OrderedDict([("rows", n_rows), ("ndcg", ndcg),
+        ("compiled_max_error", float(np.abs(np.concatenate(compiled_scores) - np.concatenate(sklearn_scores)).max())),
+        ("stages", OrderedDict())])
+    for name in STAGES:
+        stage = stages[name]
+        result["stages"][name] = OrderedDict((key, stage[key]) for key in ["wall", "cpu", "rss_end_mb", "rss_delta_mb",
+            "peak_rss_mb", "rows_per_sec"])
+    return result
+
+def compare(result, baseline, tolerance=1.25):
+    """
+    Print the stage timings next to the baseline and list the regressions.
+
+    Args:
+        result: output of run().
+        baseline: an earlier output of run() for the same size, or None.
+        tolerance: slowdown ratio of the wall time flagged as a regression.
+
+    Returns:
+        list of regressed stages.
+    """
+    regressions = []
+    print("{:<18}{:>10}{:>10}{:>10}{:>14}{:>10}{:>10}{:>10}".format("stage", "wall s", "base s", "ratio", "rows/s", "RSS MB",
+        "+RSS MB", "peak MB"))
+    for name, stage in result["stages"].items():
+        base = baseline["stages"].get(name) if baseline else None
+        ratio = stage["wall"] / base["wall"] if base and base["wall"] else None
+        flag = ""
+        if ratio is not None and ratio > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:<18}{:>10.3f}{:>10}{:>10}{:>14.0f}{:>10.0f}{:>10.0f}{:>10.0f}{}".format(name, stage["wall"],
+            "{:.3f}".format(base["wall"]) if base else "-", "{:.2f}".format(ratio) if ratio else "-",
+            stage["rows_per_sec"] or 0, stage["rss_end_mb"] or 0, stage["rss_delta_mb"] or 0, stage["peak_rss_mb"] or 0, flag))
+    print("nDCG@38 {:.4f} (baseline {})".format(result["ndcg"], "{:.4f}".format(baseline["ndcg"]) if baseline else "-"))
+    print("single searches, compiled vs sklearn: max error {:.1e}, {:.1f}x faster".format(result["compiled_max_error"],
+        result["stages"]["serve_sklearn"]["wall"] / result["stages"]["serve_compiled"]["wall"]))
+    return regressions
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic Expedia data.")
+    parser.add_argument("sizes", nargs="*", type=float, help="row counts, e.g. 1e5 1e6 (default: benchmark_rows)")
+    parser.add_argument("--update", action="store_true", help="record the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="wall time ratio flagged as a regression")
+    parser.add_argument("--n-jobs", type=int, default=1)
+    args = parser.parse_args()
+
+    paths = data_import.get_paths()
+    baseline_path = paths["benchmark_path"]
+    baselines = load_baseline(baseline_path)
+    regressions = []
+    for n_rows in [int(size) for size in args.sizes] or [paths["benchmark_rows"]]:
+        print("Benchmarking {} rows...".format(n_rows))
+        result = run(n_rows, n_jobs=args.n_jobs)
+        regressions += compare(result, baselines.get(str(n_rows)), args.tolerance)
+        if args.update or str(n_rows) not in baselines:
+            baselines[str(n_rows)] = result
+    directory = os.path.dirname(baseline_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(baseline_path, "w") as f:
+        json.dump(baselines, f, indent=2)
+    if regressions:
+        print("Regressions: " + ", ".join(regressions))
+        sys.exit(1)
+
+if __name__=="__main__":
+    main()
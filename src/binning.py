@@ -0,0 +1,74 @@
+import numpy as np
+
+class BinMapper(object):
+    """
+    Quantize a feature matrix into small integer bin codes.
+
+    The edges are learned once on the training features; a column with at
+    most max_bins distinct values gets one bin per value, other columns get
+    quantile bins. A value x falls into bin searchsorted(edges, x), so
+    x <= edges[b] exactly when its code is <= b. Missing values get their
+    own code, the largest of the dtype (missing_code), above every bin, so
+    they are never merged with the top bin and trees can split them off.
+    Codes are uint8 (uint16 from 256 bins): trees split on
+    codes the same way as on the raw values, with 8x less memory than the
+    float64 matrix and at most max_bins thresholds per feature.
+
+    Args:
+        max_bins: the maximum number of bins per feature.
+        subsample: the number of rows the edges are learned on.
+        random_state: seed of the subsample.
+    """
+    def __init__(self, max_bins=255, subsample=200000, random_state=42):
+        self.max_bins = max_bins
+        self.subsample = subsample
+        self.random_state = random_state
+
+    @property
+    def dtype(self):
+        return np.uint8 if self.max_bins < 256 else np.uint16
+
+    @property
+    def missing_code(self):
+        return np.iinfo(self.dtype).max
+
+    def fit(self, X):
+        """
+        Learn the bin edges of every column of X.
+        """
+        X = np.asarray(X, dtype=float)
+        if self.subsample is not None and len(X) > self.subsample:
+            rng = np.random.RandomState(self.random_state)
+            X = X[rng.choice(len(X), self.subsample, replace=False)]
+        self.edges_ = []
+        for j in range(X.shape[1]):
+            column = X[:,j][~np.isnan(X[:,j])]
+            values = np.unique(column)
+            if len(values) <= self.max_bins:
+                self.edges_.append(values[:-1])
+            else:
+                quantiles = np.linspace(0, 100, self.max_bins + 1)[1:-1]
+                self.edges_.append(np.unique(np.percentile(column, quantiles)))
+        return self
+
+    def transform(self, X):
+        """
+        Map a feature matrix to bin codes.
+        """
+        X = np.asarray(X, dtype=float)
+        codes = np.empty(X.shape, dtype=self.dtype)
+        for j, edges in enumerate(self.edges_):
+            codes[:,j] = np.searchsorted(edges, X[:,j], side="left")
+            codes[np.isnan(X[:,j]),j] = self.missing_code
+        return codes
+
+    def fit_transform(self, X):
+        return self.fit(X).transform(X)
+
+    def threshold(self, feature, code):
+        """
+        Raw feature value of a split between bin 'code' and the next one;
+        inf for a split between the top bin and the missing values.
+        """
+        edges = self.edges_[feature]
+        return edges[code] if code < len(edges) else np.inf
@@ -0,0 +1,182 @@
+import data_import
+import evaluate
+import profiling
+import argparse
+import numpy as np
+import pandas as pd
+
+## blending methods: mean of the per-search ranks, or of the raw scores
+METHODS = ["rank", "mean"]
+
+class BlendInput(object):
+    """
+    Buffered reader of one submission (.csv/.csv.gz) or score file.
+
+    A submission only holds an order, so its value is the position of a
+    row within its search; a score file (data_import.ScoreWriter) holds
+    the raw scores and is memory-mapped. Either way rows are read in
+    chunks and must be sorted by srch_id.
+
+    Args:
+        path: input path; files ending with '.scores' are score files.
+        chunksize: the number of rows read at once.
+    """
+    def __init__(self, path, chunksize=1000000):
+        self.path = path
+        self.is_scores = path.endswith(".scores")
+        self.chunks = self._read(chunksize)
+        self.srch_ids, self.prop_ids, self.values = np.zeros(0, np.int32), np.zeros(0, np.int32), np.zeros(0)
+        self.done = False
+
+    def _read(self, chunksize):
+        if self.is_scores:
+            records = data_import.read_scores(self.path)
+            for start in range(0, len(records), chunksize):
+                block = records[start:start + chunksize]
+                yield block["srch_id"], block["prop_id"], block["score"].astype(float)
+        else:
+            position = 0
+            for chunk in pd.read_csv(self.path, chunksize=chunksize, dtype=np.int32):
+                yield chunk["SearchId"].values, chunk["PropertyId"].values, np.arange(position, position + len(chunk), dtype=float)
+                position += len(chunk)
+
+    @property
+    def last_id(self):
+        return self.srch_ids[-1] if len(self.srch_ids) else -1
+
+    def fill(self):
+        """
+        Append the next chunk to the buffer.
+        """
+        try:
+            srch_ids, prop_ids, values = next(self.chunks)
+        except StopIteration:
+            self.done = True
+            return
+        if np.any(srch_ids[1:] < srch_ids[:-1]) or (len(srch_ids) and srch_ids[0] < self.last_id):
+            raise ValueError("{} is not sorted by srch_id".format(self.path))
+        self.srch_ids = np.r_[self.srch_ids, srch_ids]
+        self.prop_ids = np.r_[self.prop_ids, prop_ids]
+        self.values = np.r_[self.values, values]
+
+    def take(self, bound):
+        """
+        Remove and return the buffered rows with srch_id below bound.
+        """
+        end = np.searchsorted(self.srch_ids, bound)
+        rows = self.srch_ids[:end], self.prop_ids[:end], self.values[:end]
+        self.srch_ids, self.prop_ids, self.values = self.srch_ids[end:], self.prop_ids[end:], self.values[end:]
+        return rows
+
+def search_ranks(search, starts, values):
+    """
+    Rank (0 first) of every row within its search by ascending value.
+    """
+    order = np.lexsort((values, search))
+    rank = np.empty(len(order))
+    rank[order] = np.arange(len(order)) - starts[search[order]]
+    return rank
+
+def blend_block(blocks, paths, weights, method):
+    """
+    Blend the rows of the same searches read from every input.
+
+    Args:
+        blocks: list of (srch_ids, prop_ids, values), one per input.
+        paths: input paths, for error messages.
+        weights: array of input weights, summing to 1.
+        method: 'rank' to average per-search ranks, 'mean' to average the
+            raw values (scores, or the positions of submissions; blend()
+            does not mix the two).
+
+    Returns:
+        (srch_ids, prop_ids, blended score), sorted by (srch_id, prop_id),
+        lower ranks first.
+    """
+    blended = None
+    for (srch_ids, prop_ids, values), path, weight in zip(blocks, paths, weights):
+        order = np.lexsort((prop_ids, srch_ids))
+        srch_ids, prop_ids, values = srch_ids[order], prop_ids[order], values[order]
+        if blended is None:
+            keys = srch_ids, prop_ids
+            starts, search = evaluate.search_starts(srch_ids)
+            blended = np.zeros(len(srch_ids))
+        elif not (np.array_equal(srch_ids, keys[0]) and np.array_equal(prop_ids, keys[1])):
+            raise ValueError("{} does not hold the same (srch_id, prop_id) rows as {}".format(path, paths[0]))
+        if method == "rank":
+            values = search_ranks(search, starts, values)
+        blended += weight * values
+    return keys[0], keys[1], blended
+
+def blend(paths, output=None, weights=None, method="rank", chunksize=1000000):
+    """
+    Blend many submission/score files into one submission in bounded memory.
+
+    The inputs are read in lockstep, one chunk at a time from the input
+    that is furthest behind, and every search that is complete in all of
+    them is aligned by (srch_id, prop_id), blended and written out, so
+    only about one chunk per input is held in memory.
+
+    Args:
+        paths: input paths (.csv/.csv.gz submissions or .scores files).
+        output: output path; '.scores' writes a score file (defaults to
+            SETTINGS.json's blend_path).
+        weights: one weight per input (equal weights if None).
+        method: 'rank' (per-search rank averaging) or 'mean' (of the raw
+            scores of score files, or the positions of submissions).
+        chunksize: the number of rows read at once per input.
+
+    Returns:
+        the number of rows written.
+    """
+    if method not in METHODS:
+        raise ValueError("method must be one of {}".format(METHODS))
+    weights = np.ones(len(paths)) if weights is None else np.asarray(weights, dtype=float)
+    if len(weights) != len(paths):
+        raise ValueError("one weight per input is needed")
+    weights = weights / weights.sum()
+    if method == "mean" and len(set(path.endswith(".scores") for path in paths)) > 1:
+        ## positions and raw scores are on different scales
+        raise ValueError("method 'mean' needs all inputs to be score files or all submissions")
+    output = output or data_import.get_paths()["blend_path"]
+    inputs = [BlendInput(path, chunksize) for path in paths]
+    writer = data_import.ScoreWriter(output) if output.endswith(".scores") else data_import.SubmissionWriter(output)
+    n_rows = 0
+    with writer:
+        while True:
+            pending = [inp for inp in inputs if not inp.done]
+            if pending:
+                min(pending, key=lambda inp: inp.last_id).fill()
+                pending = [inp for inp in inputs if not inp.done]
+            ## the last buffered search of an unfinished input may continue in its next chunk
+            bound = min(inp.last_id for inp in pending) if pending else np.iinfo(np.int64).max
+            blocks = [inp.take(bound) for inp in inputs]
+            if any(len(block[0]) for block in blocks):
+                srch_ids, prop_ids, scores = blend_block(blocks, paths, weights, method)
+                if isinstance(writer, data_import.ScoreWriter):
+                    writer.write(srch_ids, prop_ids, scores)
+                else:
+                    writer.write(srch_ids, prop_ids, scores, grouped=True)
+                n_rows += len(srch_ids)
+            if not pending:
+                break
+    return n_rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Blend submission and score files.")
+    parser.add_argument("paths", nargs="+", help="submissions (.csv, .csv.gz) or score files (.scores)")
+    parser.add_argument("--weights", nargs="+", type=float, help="one weight per input")
+    parser.add_argument("--method", choices=METHODS, default="rank")
+    parser.add_argument("--output", help="output path (default: blend_path)")
+    parser.add_argument("--chunksize", type=int, default=1000000)
+    args = parser.parse_args()
+
+    paths = data_import.get_paths()
+    profiling.configure(paths)
+    print("Blending {} files..".format(len(args.paths)))
+    with profiling.stage("blend") as span:
+        span.rows = blend(args.paths, args.output, args.weights, args.method, args.chunksize)
+    profiling.save_trace(paths, "blend")
+
+if __name__=="__main__":
+    main()
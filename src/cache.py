@@ -0,0 +1,221 @@
+import os
+import json
+import pickle
+import shutil
+import hashlib
+import inspect
+import numpy as np
+import pandas as pd
+import data_import
+import profiling
+import sampling
+
+def source_key(path):
+    """
+    Describe a source file by its size and modification time.
+
+    Args:
+        path: path of the source file.
+
+    Returns:
+        list of [size, mtime].
+    """
+    stat = os.stat(path)
+    return [stat.st_size, int(stat.st_mtime)]
+
+def code_key(*objs):
+    """
+    Hash the source code of the given modules/functions.
+    """
+    h = hashlib.sha1()
+    for obj in objs:
+        h.update(inspect.getsource(obj).encode("utf-8"))
+    return h.hexdigest()
+
+def local_imports(module):
+    """
+    The modules of this package a module imports, or imports names from,
+    sorted by name.
+    """
+    directory = os.path.dirname(os.path.abspath(module.__file__))
+    found = {}
+    for value in vars(module).values():
+        dependency = value if inspect.ismodule(value) else inspect.getmodule(value)
+        path = getattr(dependency, "__file__", None)
+        if dependency is not module and path and os.path.dirname(os.path.abspath(path)) == directory:
+            found[dependency.__name__] = dependency
+    return [found[name] for name in sorted(found)]
+
+def cache_key(path, code=(), extra=()):
+    """
+    Build the cache key of a data file.
+
+    Args:
+        path: path of the source file.
+        code: modules/functions whose source the cached data depends on.
+        extra: other json-serializable values the cached data depends on.
+
+    Returns:
+        hex digest.
+    """
+    key = [source_key(path), code_key(*code), list(extra)]
+    return hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()[:16]
+
+def save_frame(df, directory, state=None):
+    """
+    Write a data object as one .npy file per column plus a manifest.
+
+    Args:
+        df: data object.
+        directory: cache directory, must not exist yet.
+        state: object pickled along with the data (e.g. a fitted transformer).
+
+    Returns:
+        None.
+    """
+    os.makedirs(directory)
+    columns = []
+    for i, name in enumerate(df.columns):
+        file_name = str(i) + ".npy"
+        values = df[name].values
+        np.save(os.path.join(directory, file_name), values, allow_pickle=values.dtype == object)
+        columns.append({"name": name, "file": file_name, "dtype": str(values.dtype)})
+    if state is not None:
+        with open(os.path.join(directory, "state.pickle"), "wb") as f:
+            pickle.dump(state, f)
+    manifest = {"nrows": len(df), "columns": columns}
+    with open(os.path.join(directory, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+
+def load_state(directory):
+    """
+    Read the object pickled along with a cached data object, if any.
+    """
+    path = os.path.join(directory, "state.pickle")
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+def load_frame(directory, mmap=True):
+    """
+    Read a data object written by save_frame().
+
+    Args:
+        directory: cache directory.
+        mmap: memory-map the column files instead of reading them.
+
+    Returns:
+        data object.
+    """
+    with open(os.path.join(directory, "manifest.json")) as f:
+        manifest = json.load(f)
+    data = {}
+    for column in manifest["columns"]:
+        path = os.path.join(directory, column["file"])
+        if column["dtype"] == "object":
+            data[column["name"]] = np.load(path, allow_pickle=True)
+        else:
+            data[column["name"]] = np.load(path, mmap_mode="r" if mmap else None)
+    return pd.DataFrame(data, columns=[c["name"] for c in manifest["columns"]])
+
+def cached(layer, path, build, code=(), extra=()):
+    """
+    Load a data object from the cache, building and storing it on a miss.
+
+    Args:
+        layer: cache layer name (e.g. 'raw' or 'features').
+        path: path of the source file the data is derived from.
+        build: function returning (data object, state) on a cache miss.
+        code: modules/functions whose source the data depends on.
+        extra: other values the data depends on (e.g. nrows).
+
+    Returns:
+        (data object, state).
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    layer_dir = os.path.join(data_import.get_paths()["cache_path"], layer)
+    directory = os.path.join(layer_dir, name + "-" + cache_key(path, code, extra))
+    if os.path.exists(os.path.join(directory, "manifest.json")):
+        print("Reading cached {} {}...".format(layer, name))
+        with profiling.stage("read cached " + layer) as span:
+            df = load_frame(directory)
+            state = load_state(directory)
+            span.rows = len(df)
+        return df, state
+
+    df, state = build()
+    ## write to a temporary directory first so an interrupted run never leaves a half cache
+    tmp_directory = directory + ".tmp"
+    if os.path.exists(tmp_directory):
+        shutil.rmtree(tmp_directory)
+    save_frame(df, tmp_directory, state)
+    ## drop stale entries of the same file
+    for entry in os.listdir(layer_dir):
+        if entry.startswith(name + "-") and not entry.endswith(".tmp"):
+            shutil.rmtree(os.path.join(layer_dir, entry))
+    os.rename(tmp_directory, directory)
+    return df, state
+
+def load_raw(kind="train", nrows=10000):
+    """
+    Load the parsed train/test data set through the raw cache layer.
+
+    Args:
+        kind: 'train' or 'test'.
+        nrows: the number of rows to read in (None for the full file).
+
+    Returns:
+        data object.
+    """
+    path = data_import.get_paths()[kind + "_path"]
+    def build():
+        print("Reading {} data...".format(kind))
+        with profiling.stage("read " + kind) as span:
+            df = data_import.read_compact(path, nrows=nrows)
+            span.rows = len(df)
+        return df, None
+    return cached("raw", path, build, code=(data_import,), extra=(nrows,))[0]
+
+def load_features(kind, feature_eng, nrows=10000, depends=(), sample=None):
+    """
+    Load the feature-engineered train/test data set through the features cache layer.
+
+    Args:
+        kind: 'train' or 'test'.
+        feature_eng: feature engineering function, applied in place; its
+            return value (e.g. the fitted transformer) is cached as well.
+        nrows: the number of rows to read in (None for the full file).
+        depends: other files the features depend on (e.g. a saved transformer).
+        sample: if given, dict of sampling.sample_searches() arguments; the
+            first nrows rows are then streamed in chunks and only the
+            sampled searches are engineered, feature_eng getting a
+            'stream' argument returning the chunks again.
+
+    Returns:
+        (data object, return value of feature_eng).
+    """
+    path = data_import.get_paths()[kind + "_path"]
+    def build():
+        if sample is not None:
+            with profiling.stage("sample " + kind) as span:
+                df = sampling.sample_searches(data_import.read_chunks(path, nrows=nrows), **sample)
+                span.rows = len(df)
+        else:
+            ## memory-mapped columns are read-only
+            df = load_raw(kind, nrows).copy()
+        with profiling.stage("feature_eng") as span:
+            if sample is not None:
+                ## the statistics are learned on every row the sample was drawn from
+                state = feature_eng(df, stream=lambda: data_import.read_chunks(path, nrows=nrows))
+            else:
+                state = feature_eng(df)
+            span.rows = len(df)
+        return df, state
+    ## feature_eng may be a functools.partial of the feature engineering function;
+    ## the transformer also depends on the modules it imports (binning, stats_engine, ...)
+    module = inspect.getmodule(getattr(feature_eng, "func", feature_eng))
+    code = (data_import, sampling, module) + tuple(m for m in local_imports(module) if m not in (data_import, sampling))
+    ## and its keyword arguments (e.g. use_summary) change the features too
+    extra = [nrows, sample, sorted(getattr(feature_eng, "keywords", {}).items())] + [source_key(p) for p in depends]
+    return cached("features", path, build, code=code, extra=extra)
@@ -0,0 +1,198 @@
+import data_import
+import cache
+import evaluate
+import scoring
+import profiling
+import tuning
+import sys
+import time
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+
+## features of the first-stage model, those missing from the transformer are skipped
+PRESCORER_FEATURES = ["prop_location_score2", "prop_location_score1", "prop_review_score", "prop_starrating",
+    "prop_log_historical_price", "price_usd", "promotion_flag", "random_bool", "prop_click_rate", "prop_book_rate"]
+
+## candidates per search kept for the full models in the trade-off report
+REPORT_KS = [5, 10, 15, 20, 25, 30]
+
+class PreScorer(object):
+    """
+    First stage of the cascade: a logistic regression of click_bool on a
+    handful of features.
+
+    The features are standardized for the fit and the scaling is folded
+    back into the coefficients, so scoring is one small dot product per
+    row on the same (possibly binned) matrix as the full models.
+
+    Args:
+        features: feature names used (see PRESCORER_FEATURES).
+        C: inverse regularization strength of the logistic regression.
+    """
+    def __init__(self, features=None, C=1.0):
+        self.features = features or PRESCORER_FEATURES
+        self.C = C
+
+    def fit(self, X, y, feature_names):
+        """
+        Fit on the feature matrix of the transformer.
+
+        Args:
+            X: feature matrix (transformer.matrix()).
+            y: array of 0/1 outcomes.
+            feature_names: names of the columns of X.
+        """
+        self.columns_ = [feature_names.index(name) for name in self.features if name in feature_names]
+        self.coef_, self.intercept_ = self._fit(X, y)
+        self.n_rows_ = len(y)
+        return self
+
+    def update(self, X, y):
+        """
+        Merge a batch of new rows into the fit: a model fitted on the batch
+        alone is averaged with the current one, weighted by the number of
+        rows each was fitted on.
+        """
+        coef, intercept = self._fit(X, y)
+        n_rows = getattr(self, "n_rows_", len(y))
+        weight = len(y) / float(n_rows + len(y))
+        self.coef_ = (1 - weight) * self.coef_ + weight * coef
+        self.intercept_ = (1 - weight) * self.intercept_ + weight * intercept
+        self.n_rows_ = n_rows + len(y)
+        return self
+
+    def _fit(self, X, y):
+        Z = X[:,self.columns_].astype(float)
+        mean, std = Z.mean(axis=0), Z.std(axis=0)
+        std[std == 0] = 1.0
+        model = LogisticRegression(C=self.C, max_iter=1000).fit((Z - mean) / std, y)
+        coef = model.coef_[0] / std
+        return coef, model.intercept_[0] - np.dot(coef, mean)
+
+    def decision_function(self, X):
+        """
+        Score of every row, higher ranks first.
+        """
+        return np.dot(X[:,self.columns_].astype(float), self.coef_) + self.intercept_
+
+    def cascade_scores(self, X, srch_ids, full_scores, k):
+        """
+        Two-stage scores of the rows with this pre-scorer (see cascade_scores()).
+        """
+        return cascade_scores(X, srch_ids, self, full_scores, k)
+
+def top_k_rows(srch_ids, scores, k):
+    """
+    Find the k best scored rows of every search.
+
+    Args:
+        srch_ids: array of search ids, rows of a search contiguous.
+        scores: array of scores, higher ranks first.
+        k: the number of rows kept per search.
+
+    Returns:
+        (boolean mask of the kept rows, rank of every row within its search).
+    """
+    starts, search = evaluate.search_starts(srch_ids)
+    order = np.lexsort((-np.asarray(scores), search))
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order)) - starts[search[order]]
+    return rank < k, rank
+
+def cascade_scores(X, srch_ids, prescorer, full_scores, k, pre_scores=None):
+    """
+    Score rows in two stages: the pre-scorer ranks every row and only the
+    top k of every search are scored by the full models.
+
+    Args:
+        X: feature matrix, rows of a search contiguous.
+        srch_ids: array of search ids.
+        prescorer: fitted PreScorer.
+        full_scores: function of a feature matrix returning the scores of
+            the full models (higher ranks first).
+        k: the number of rows per search scored by the full models.
+        pre_scores: the pre-scorer's decision_function() of X, if already
+            computed.
+
+    Returns:
+        array of scores: the top k rows of a search keep their full score
+        and rank above the others, which keep the order of the pre-scorer.
+    """
+    if pre_scores is None:
+        pre_scores = prescorer.decision_function(X)
+    top, rank = top_k_rows(srch_ids, pre_scores, k)
+    scores = np.empty(len(top))
+    if top.any():
+        scores[top] = full_scores(X[top])
+        floor = scores[top].min()
+    else:
+        floor = 0.0
+    scores[~top] = floor - 1.0 - rank[~top]
+    return scores
+
+def fit_prescorer(X, train, feature_names, rng):
+    """
+    Fit the pre-scorer on balanced click_bool rows of the training features.
+    """
+    y = train["click_bool"].values
+    rows = tuning.balanced_indices(y, np.arange(len(y)), rng)
+    return PreScorer().fit(X[rows], y[rows], feature_names)
+
+def main():
+    """
+    Report the latency/nDCG trade-off of the cascade on held-out searches
+    for the k given as arguments (REPORT_KS by default).
+
+    The pre-scorer runs once and its cost is reported on its own; the
+    cascade times add it to the cost of the top-k rows of the full models.
+    """
+    paths = data_import.get_paths()
+    profiling.configure(paths)
+    if paths["model_type"] == "lambdarank":
+        print("The cascade is only supported for the ensemble models")
+        sys.exit(1)
+    ks = [int(arg) for arg in sys.argv[1:]] or REPORT_KS
+    scoring.init_scorer()
+    transformer = scoring._scorer["transformer"]
+    prescorer = data_import.load_prescorer()
+    _, holdout = evaluate.holdout_split(evaluate.unfitted_searches(cache.load_raw("train", nrows=None), transformer))
+    holdout = holdout.copy()
+    transformer.transform(holdout)
+    X = transformer.matrix(holdout)
+    srch_ids = holdout["srch_id"].values
+
+    print("Scoring {} holdout rows ({} searches)..".format(len(holdout), len(np.unique(srch_ids))))
+    with profiling.stage("full") as span:
+        tstart = time.time()
+        scores = scoring.ensemble_scores(X)
+        full_time = time.time() - tstart
+        span.rows = len(holdout)
+    full_ndcg = evaluate.evaluate_frame(holdout, scores)
+    with profiling.stage("prescorer") as span:
+        tstart = time.time()
+        pre_scores = prescorer.decision_function(X)
+        pre_time = time.time() - tstart
+        span.rows = len(holdout)
+
+    per_1k = lambda seconds: 1000 * seconds / len(holdout) * 1000
+    print("Pre-scorer: {:.3f} ms/1k rows".format(per_1k(pre_time)))
+    print("{:>6}{:>10}{:>12}{:>12}{:>12}{:>10}{:>10}".format("k", "full %", "models ms", "total ms",
+        "speedup", "nDCG", "delta"))
+    print("{:>6}{:>10.1f}{:>12.2f}{:>12.2f}{:>12.2f}{:>10.4f}{:>10.4f}".format("all", 100.0, per_1k(full_time),
+        per_1k(full_time), 1.0, full_ndcg, 0.0))
+    for k in [0] + ks:
+        with profiling.stage("cascade k={}".format(k), report=False) as span:
+            tstart = time.time()
+            scores = cascade_scores(X, srch_ids, prescorer, scoring.ensemble_scores, k, pre_scores)
+            wall = time.time() - tstart
+            span.rows = len(holdout)
+        score = evaluate.evaluate_frame(holdout, scores)
+        share = top_k_rows(srch_ids, pre_scores, k)[0].mean() if k else 0.0
+        total = pre_time + wall
+        print("{:>6}{:>10.1f}{:>12.2f}{:>12.2f}{:>12.2f}{:>10.4f}{:>10.4f}".format(k, 100 * share, per_1k(wall),
+            per_1k(total), full_time / total if total else float("inf"), score, score - full_ndcg))
+    print("(ms per 1k rows; 'models ms' is the full models on the top k rows, 'total ms' adds the pre-scorer)")
+    profiling.save_trace(paths, "cascade")
+
+if __name__=="__main__":
+    main()
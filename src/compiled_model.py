@@ -0,0 +1,288 @@
+import data_import
+import profiling
+import numpy as np
+from artifact import save_artifact, load_artifact, read_manifest
+from features import FeatureTransformer
+
+## term kinds: leaves summed as they are (forests, weights folded in) or
+## summed as raw scores and passed through a sigmoid (gradient boosting)
+LINEAR = 0
+LOGISTIC = 1
+
+def voting_components(model):
+    """
+    List the fitted sub-estimators of a model with their normalized weights.
+
+    Args:
+        model: fitted soft VotingClassifier, forest or gradient boosting classifier.
+
+    Returns:
+        list of (estimator, weight).
+    """
+    if not hasattr(model, "voting"):
+        return [(model, 1.0)]
+    if model.voting != "soft":
+        raise ValueError("only soft voting ensembles can be compiled")
+    weights = model.weights if model.weights is not None else [1.0] * len(model.estimators_)
+    weights = np.asarray(weights, dtype=float) / np.sum(weights)
+    return list(zip(model.estimators_, weights))
+
+def float32_floor(threshold):
+    """
+    Round thresholds down to float32.
+
+    For float32 x, x <= t holds exactly when x <= float32_floor(t), so
+    the comparisons sklearn does against float64 thresholds can be done
+    in float32.
+    """
+    t32 = np.asarray(threshold).astype(np.float32)
+    above = t32.astype(float) > threshold
+    t32[above] = np.nextafter(t32[above], np.float32(-np.inf))
+    return t32
+
+def sparse_tree(tree, leaf_value):
+    """
+    Lay a fitted sklearn tree out with the two children of a node adjacent.
+
+    Nodes are renumbered breadth first, so a row at an internal node moves
+    to left + (x > threshold). Leaves point to themselves with threshold
+    +inf, so rows that reached a leaf stay there for the remaining steps.
+
+    Args:
+        tree: sklearn Tree object (estimator.tree_).
+        leaf_value: value of every node of the tree.
+
+    Returns:
+        (feature, threshold, left, value) of the tree.node_count nodes,
+        left counted from the root.
+    """
+    order = [0]
+    left = np.zeros(tree.node_count, dtype=np.int32)
+    for pos, node in enumerate(order):
+        if tree.children_left[node] == -1:
+            left[pos] = pos
+        else:
+            left[pos] = len(order)
+            order.extend([tree.children_left[node], tree.children_right[node]])
+    order = np.asarray(order)
+    internal = tree.children_left[order] != -1
+    feature = np.where(internal, tree.feature[order], 0).astype(np.int32)
+    threshold = np.where(internal, float32_floor(tree.threshold[order]), np.inf).astype(np.float32)
+    value = np.where(internal, 0.0, leaf_value[order])
+    return feature, threshold, left, value
+
+class CompiledEnsemble(object):
+    """
+    Flat array-based scorer for fitted tree ensembles.
+
+    The nodes of all trees of the compiled models are concatenated into
+    flat arrays (feature, threshold, left child, value), with no padding,
+    and the trees are grouped by depth. Forest leaves hold the positive
+    class probability pre-multiplied by the soft-vote weight and
+    1 / n_trees; gradient boosting leaves hold learning_rate * value and
+    are summed per component before the sigmoid. leaf_values() moves every
+    row down all trees of a depth group at once, one level per step.
+
+    It has none of the per-call overhead of sklearn, so it scores a single
+    search several times faster (serve.py), but its numpy traversal is
+    slower than sklearn's on large batches, which stay with sklearn.
+
+    Args:
+        models: fitted classifiers (e.g. [book_model, click_model]).
+        names: output names, one per model.
+    """
+    ARRAYS = ["feature", "threshold", "left", "value", "tree_root", "tree_term", "group_depth", "group_trees",
+        "term_model", "term_kind", "term_bias", "term_scale", "term_weight"]
+
+    def __init__(self, models=(), names=()):
+        self.names = list(names)
+        trees = []
+        term_model, term_kind, term_bias, term_scale, term_weight = [], [], [], [], []
+        for m, model in enumerate(models):
+            forest_term = len(term_model)
+            term_model.append(m)
+            term_kind.append(LINEAR)
+            term_bias.append(0.0)
+            term_scale.append(1.0)
+            term_weight.append(1.0)
+            for est, weight in voting_components(model):
+                estimators = np.asarray(est.estimators_, dtype=object)
+                if estimators.ndim == 1:
+                    ## random forest / extra trees: average of leaf class fractions
+                    for tree in estimators:
+                        v = tree.tree_.value[:,0,:]
+                        proba = v[:,1] / v.sum(axis=1)
+                        trees.append((tree.tree_, weight * proba / len(estimators), forest_term))
+                else:
+                    ## gradient boosting: sigmoid of the boosted raw score
+                    term = len(term_model)
+                    term_model.append(m)
+                    term_kind.append(LOGISTIC)
+                    term_scale.append(2.0 if est.loss == "exponential" else 1.0)
+                    term_weight.append(weight)
+                    probe = np.zeros((1, estimators[0,0].tree_.n_features), dtype=np.float32)
+                    raw = sum(tree.predict(probe)[0] for tree in estimators[:,0])
+                    term_bias.append(est.decision_function(probe).ravel()[0] - est.learning_rate * raw)
+                    for tree in estimators[:,0]:
+                        trees.append((tree.tree_, est.learning_rate * tree.tree_.value[:,0,0], term))
+
+        feature, threshold, left, value, tree_root, tree_term = [], [], [], [], [], []
+        n_nodes = 0
+        depths = sorted(set(tree.max_depth for tree, _, _ in trees))
+        self.group_depth = np.asarray(depths, dtype=np.int32)
+        self.group_trees = np.zeros(len(depths), dtype=np.int32)
+        for g, depth in enumerate(depths):
+            for tree, leaf_value, term in trees:
+                if tree.max_depth == depth:
+                    f, t, l, v = sparse_tree(tree, leaf_value)
+                    feature.append(f)
+                    threshold.append(t)
+                    left.append(l + n_nodes)
+                    value.append(v)
+                    tree_root.append(n_nodes)
+                    tree_term.append(term)
+                    n_nodes += len(f)
+                    self.group_trees[g] += 1
+
+        self.feature = np.concatenate(feature) if feature else np.zeros(0, np.int32)
+        self.threshold = np.concatenate(threshold) if threshold else np.zeros(0, np.float32)
+        self.left = np.concatenate(left) if left else np.zeros(0, np.int32)
+        self.value = np.concatenate(value) if value else np.zeros(0)
+        self.tree_root = np.asarray(tree_root, dtype=np.int32)
+        self.tree_term = np.asarray(tree_term, dtype=np.int32)
+        self.term_model = np.asarray(term_model, dtype=np.int32)
+        self.term_kind = np.asarray(term_kind, dtype=np.int32)
+        self.term_bias = np.asarray(term_bias, dtype=float)
+        self.term_scale = np.asarray(term_scale, dtype=float)
+        self.term_weight = np.asarray(term_weight, dtype=float)
+
+    def leaf_values(self, X):
+        """
+        Find the leaf value of every tree for every row.
+
+        Args:
+            X: feature matrix (compared as float32, like sklearn).
+
+        Returns:
+            matrix of shape (rows, trees), trees in tree_term order.
+        """
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        n_rows, n_features = X.shape
+        flat_X = X.ravel()
+        row_offset = (np.arange(n_rows, dtype=np.int32) * n_features)[:,None]
+        out = np.empty((n_rows, len(self.tree_term)))
+        tree_start = 0
+        for depth, n_trees in zip(self.group_depth, self.group_trees):
+            node = np.repeat(self.tree_root[None,tree_start:tree_start + n_trees], n_rows, axis=0)
+            for _ in range(depth):
+                x = np.take(flat_X, np.take(self.feature, node) + row_offset)
+                node = np.take(self.left, node) + (x > np.take(self.threshold, node))
+            out[:,tree_start:tree_start + n_trees] = np.take(self.value, node)
+            tree_start += n_trees
+        return out
+
+    def predict_proba(self, X, chunksize=256):
+        """
+        Positive class probability of every compiled model.
+
+        Args:
+            X: feature matrix.
+            chunksize: rows traversed at once; small blocks keep the
+                (rows, trees) work arrays in cache.
+
+        Returns:
+            matrix of shape (rows, models).
+        """
+        n_trees, n_terms, n_models = len(self.tree_term), len(self.term_model), len(self.names)
+        tree_terms = np.zeros((n_trees, n_terms))
+        tree_terms[np.arange(n_trees), self.tree_term] = 1
+        term_models = np.zeros((n_terms, n_models))
+        term_models[np.arange(n_terms), self.term_model] = 1
+        logistic = self.term_kind == LOGISTIC
+
+        out = np.zeros((len(X), n_models))
+        for start in range(0, len(X), chunksize):
+            terms = np.dot(self.leaf_values(X[start:start + chunksize]), tree_terms)
+            raw = self.term_scale[logistic] * (self.term_bias[logistic] + terms[:,logistic])
+            terms[:,logistic] = self.term_weight[logistic] / (1 + np.exp(-raw))
+            out[start:start + chunksize] = np.dot(terms, term_models)
+        return out
+
+    def save(self, path, feature_names=None, sources=(), transformer=None):
+        """
+        Save the node arrays as a model artifact (see artifact.save_artifact()).
+
+        Args:
+            path: artifact directory.
+            feature_names: the transformer's feature names, checked on load.
+            sources: files the ensemble was compiled from (model pickles,
+                transformer), so a stale artifact is detected on load.
+            transformer: fitted FeatureTransformer saved along as arrays
+                (see FeatureTransformer.to_artifact()), if any.
+        """
+        arrays = dict((name, getattr(self, name)) for name in self.ARRAYS)
+        meta = {"names": self.names}
+        if transformer is not None:
+            transformer_arrays, meta["transformer"] = transformer.to_artifact()
+            arrays.update(("transformer__" + name, values) for name, values in transformer_arrays.items())
+        return save_artifact(path, arrays, feature_names, sources, meta=meta)
+
+    @classmethod
+    def load(cls, path, mmap=True, verify=False, feature_names=None):
+        """
+        Load a scorer saved by save(), its node arrays memory-mapped. The
+        transformer saved along, if any, is rebuilt as 'transformer' (None
+        otherwise), so scoring needs no pickle at all.
+
+        Raises:
+            artifact.ArtifactError: the artifact is corrupt, stale or built
+                for other features.
+        """
+        compiled = cls()
+        arrays, manifest = load_artifact(path, mmap, verify, feature_names)
+        for name in cls.ARRAYS:
+            setattr(compiled, name, arrays[name])
+        compiled.names = list(manifest["meta"]["names"])
+        compiled.transformer = None
+        if "transformer" in manifest["meta"]:
+            prefix = "transformer__"
+            transformer_arrays = dict((name[len(prefix):], values) for name, values in arrays.items() if name.startswith(prefix))
+            compiled.transformer = FeatureTransformer.from_artifact(transformer_arrays, manifest["meta"]["transformer"])
+        return compiled
+
+def load_scorer(paths):
+    """
+    Load the artifact at 'compiled_model_path' with its transformer, the
+    pickled one if it was compiled without.
+
+    Returns:
+        (CompiledEnsemble, FeatureTransformer).
+    """
+    path = paths["compiled_model_path"]
+    transformer = None if "transformer" in read_manifest(path)["meta"] else data_import.load_transformer()
+    compiled = CompiledEnsemble.load(path, feature_names=getattr(transformer, "feature_names_", None))
+    return compiled, compiled.transformer or transformer
+
+def build(paths, book_model, click_model, transformer):
+    """
+    Compile both classifiers into the artifact at 'compiled_model_path',
+    along with the arrays of the transformer.
+    """
+    compiled = CompiledEnsemble([book_model, click_model], ["book", "click"])
+    compiled.save(paths["compiled_model_path"], getattr(transformer, "feature_names_", None),
+        sources=[paths["model_path_book"], paths["model_path_click"], paths["transformer_path"]], transformer=transformer)
+    return compiled
+
+def main():
+    paths = data_import.get_paths()
+    profiling.configure(paths)
+    print("Compiling the Booking and Click classifiers...")
+    with profiling.stage("compile"):
+        compiled = build(paths, data_import.load_model(True), data_import.load_model(False), data_import.load_transformer())
+        print("{} trees, {} nodes".format(len(compiled.tree_term), len(compiled.feature)))
+    with profiling.stage("load compiled"):
+        CompiledEnsemble.load(paths["compiled_model_path"], verify=True)
+    profiling.save_trace(paths, "compiled_model")
+
+if __name__=="__main__":
+    main()
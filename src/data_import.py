@@ -1,10 +1,56 @@
 import os
 import json
+import numpy as np
 import pandas as pd
-from datetime import datetime
-from operator import itemgetter
+import profiling
 import csv
+import gzip
+import itertools
 import pickle
+import shutil
+
+## compact schema for the raw csv files: ids as int32, flags as uint8 and
+## scores/prices as float32 (columns with missing values have to stay float)
+DTYPES = {
+    "srch_id": np.int32,
+    "site_id": np.int32,
+    "visitor_location_country_id": np.int32,
+    "visitor_hist_starrating": np.float32,
+    "visitor_hist_adr_usd": np.float32,
+    "prop_country_id": np.int32,
+    "prop_id": np.int32,
+    "prop_starrating": np.uint8,
+    "prop_review_score": np.float32,
+    "prop_brand_bool": np.uint8,
+    "prop_location_score1": np.float32,
+    "prop_location_score2": np.float32,
+    "prop_log_historical_price": np.float32,
+    "position": np.uint8,
+    "price_usd": np.float32,
+    "promotion_flag": np.uint8,
+    "srch_destination_id": np.int32,
+    "srch_length_of_stay": np.int32,
+    "srch_booking_window": np.int32,
+    "srch_adults_count": np.uint8,
+    "srch_children_count": np.uint8,
+    "srch_room_count": np.uint8,
+    "srch_saturday_night_bool": np.uint8,
+    "srch_query_affinity_score": np.float32,
+    "orig_destination_distance": np.float32,
+    "random_bool": np.uint8,
+    "click_bool": np.uint8,
+    "gross_bookings_usd": np.float32,
+    "booking_bool": np.uint8,
+}
+for i in range(1,9):
+    DTYPES["comp"+str(i)+"_rate"] = np.float32
+    DTYPES["comp"+str(i)+"_inv"] = np.float32
+    DTYPES["comp"+str(i)+"_rate_percent_diff"] = np.float32
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+## records of the raw score files written by predict.py and read by blend.py
+SCORE_DTYPE = np.dtype([("srch_id", "<i4"), ("prop_id", "<i4"), ("score", "<f8")])
 
 def load_data(train, nrows=5):
     """
@@ -61,50 +107,344 @@ def get_paths():
     paths = json.loads(open("SETTINGS.json").read())
     return paths
 
-def load_train():
+def read_chunks(path, chunksize=None, nrows=None):
+    """
+    Stream a raw csv file in chunks with the compact schema.
+
+    Args:
+        path: path of train.csv or test.csv.
+        chunksize: the number of rows per chunk (defaults to SETTINGS.json).
+        nrows: the number of rows to read in (None for the full file).
+
+    Returns:
+        generator of data objects, 'date_time' already parsed.
+    """
+    if chunksize is None:
+        chunksize = get_paths()["chunksize"]
+    columns = pd.read_csv(path, nrows=0).columns
+    dtype = dict((k, v) for k, v in DTYPES.items() if k in columns)
+    for chunk in pd.read_csv(path, dtype=dtype, chunksize=chunksize, nrows=nrows):
+        chunk["date_time"] = pd.to_datetime(chunk["date_time"], format=DATE_FORMAT)
+        yield chunk
+
+def read_compact(path, chunksize=None, nrows=None):
+    """
+    Read a raw csv file chunk by chunk into one compact data object.
+    """
+    return pd.concat(read_chunks(path, chunksize, nrows), ignore_index=True)
+
+def iter_train(chunksize=None, nrows=None):
+    """
+    Stream training data set in chunks.
+    """
+    return read_chunks(get_paths()["train_path"], chunksize, nrows)
+
+def iter_test(chunksize=None, nrows=None):
+    """
+    Stream test data set in chunks.
+    """
+    return read_chunks(get_paths()["test_path"], chunksize, nrows)
+
+def load_train(nrows=10000, chunksize=None):
     """
     Load training data set.
+
+    Args:
+        nrows: the number of rows to read in (None for the full file).
+        chunksize: if given, read in chunks of this many rows with the
+            compact schema instead of the default float64/object parse.
     """
     print("Reading training data...")
-    tstart = datetime.now()
-    train_path = get_paths()["train_path"]
-    x = pd.read_csv(train_path, nrows=10000)
-    print("Time used:" + str(datetime.now() - tstart) + "\n")
+    with profiling.stage("read train") as span:
+        train_path = get_paths()["train_path"]
+        if chunksize:
+            x = read_compact(train_path, chunksize, nrows)
+        else:
+            x = pd.read_csv(train_path, nrows=nrows)
+        span.rows = len(x)
     return x
 
-def load_test():
+def load_test(nrows=10000, chunksize=None):
     """
     Load test data set.
+
+    Args:
+        nrows: the number of rows to read in (None for the full file).
+        chunksize: if given, read in chunks of this many rows with the
+            compact schema instead of the default float64/object parse.
     """
     print("Reading test data...")
-    tstart = datetime.now()
-    test_path = get_paths()["test_path"]
-    x = pd.read_csv(test_path, nrows=10000)
-    print("Time used:" + str(datetime.now() - tstart) + "\n")
+    with profiling.stage("read test") as span:
+        test_path = get_paths()["test_path"]
+        if chunksize:
+            x = read_compact(test_path, chunksize, nrows)
+        else:
+            x = pd.read_csv(test_path, nrows=nrows)
+        span.rows = len(x)
     return x
 
-def save_model(model, isBook=True):
+def search_chunks(df, chunksize=None):
+    """
+    Split a data object into consecutive chunks of about chunksize rows
+    without cutting a search in two.
+
+    Args:
+        df: data object grouped by 'srch_id'.
+        chunksize: the number of rows per chunk (defaults to SETTINGS.json).
+
+    Returns:
+        generator of data objects.
+    """
+    if chunksize is None:
+        chunksize = get_paths()["chunksize"]
+    ids = df["srch_id"].values
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    ## cut at the first search starting at or after every multiple of chunksize
+    cuts = np.append(starts, len(ids))[np.searchsorted(starts, np.arange(chunksize, len(ids), chunksize))]
+    bounds = np.unique(np.r_[0, cuts, len(ids)])
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        yield df.iloc[start:end]
+
+def versioned_path(path, version):
+    """
+    Path of a version of a model file, e.g. 'book_model.20130901.pickle'.
+    """
+    root, ext = os.path.splitext(path)
+    return "{}.{}{}".format(root, version, ext)
+
+def save_model(model, isBook=True, version=None):
+    """
+    Save the fitted booking (or click) classifier.
+
+    Args:
+        model: fitted classifier.
+        isBook: booking (True) or click (False) classifier.
+        version: if given, a copy is kept under versioned_path() as well.
+    """
     if isBook:
         out_path = get_paths()["model_path_book"]
     else:
         out_path = get_paths()["model_path_click"]
-    pickle.dump(model, open(out_path, "w"))
+    with open(out_path, "wb") as f:
+        pickle.dump(model, f)
+    if version is not None:
+        shutil.copyfile(out_path, versioned_path(out_path, version))
 
-def load_model(isBook=True):
+def load_model(isBook=True, version=None):
+    """
+    Load the fitted booking (or click) classifier, the current one or a
+    saved version.
+    """
     if isBook:
         in_path = get_paths()["model_path_book"]
     else:
         in_path = get_paths()["model_path_click"]
-    return pickle.load(open(in_path))
+    if version is not None:
+        in_path = versioned_path(in_path, version)
+    with open(in_path, "rb") as f:
+        return pickle.load(f)
+
+def save_ranker(model):
+    """
+    Save the fitted LambdaRank model.
+    """
+    with open(get_paths()["model_path_rank"], "wb") as f:
+        pickle.dump(model, f)
+
+def load_ranker():
+    """
+    Load the fitted LambdaRank model.
+    """
+    with open(get_paths()["model_path_rank"], "rb") as f:
+        return pickle.load(f)
 
-def write_submission(recommendations, submission_file=None):
-    submission_path = get_paths()["submission_path"]
-    rows = [(srch_id, prop_id)
-        for srch_id, prop_id, rank_float
-        in sorted(recommendations, key=itemgetter(0,2))]
+def save_prescorer(prescorer, version=None):
+    """
+    Save the fitted first-stage model of the cascade (and a copy under
+    versioned_path() if a version is given).
+    """
+    out_path = get_paths()["prescorer_path"]
+    with open(out_path, "wb") as f:
+        pickle.dump(prescorer, f)
+    if version is not None:
+        shutil.copyfile(out_path, versioned_path(out_path, version))
 
-    submission = pd.DataFrame.from_records(rows, columns=["SearchId", "PropertyId"])
-    submission.to_csv(submission_path, index=False, sep=',')
+def load_prescorer():
+    """
+    Load the fitted first-stage model of the cascade.
+    """
+    with open(get_paths()["prescorer_path"], "rb") as f:
+        return pickle.load(f)
+
+def save_transformer(transformer, version=None):
+    """
+    Save the fitted feature transformer next to the models (and a copy
+    under versioned_path() if a version is given).
+    """
+    out_path = get_paths()["transformer_path"]
+    with open(out_path, "wb") as f:
+        pickle.dump(transformer, f)
+    if version is not None:
+        shutil.copyfile(out_path, versioned_path(out_path, version))
+
+def load_transformer(version=None):
+    """
+    Load the fitted feature transformer, the current one or a saved version.
+    """
+    in_path = get_paths()["transformer_path"]
+    if version is not None:
+        in_path = versioned_path(in_path, version)
+    with open(in_path, "rb") as f:
+        return pickle.load(f)
+
+def search_order(srch_ids, scores, grouped=False):
+    """
+    Order rows by srch_id, then by score (stable, like sorted()).
+
+    Args:
+        srch_ids: array of search ids.
+        scores: array of scores, lower ranks first.
+        grouped: rows of a search are already contiguous, so only the
+            order within searches is needed and search order is kept.
+
+    Returns:
+        array of row indices.
+    """
+    srch_ids = np.asarray(srch_ids)
+    if grouped and len(srch_ids):
+        ## number the contiguous searches instead of sorting on the ids
+        srch_ids = np.cumsum(np.r_[False, srch_ids[1:] != srch_ids[:-1]])
+    return np.lexsort((scores, srch_ids))
+
+class SubmissionWriter(object):
+    """
+    Write a submission block by block.
+
+    Args:
+        path: output path (defaults to SETTINGS.json's submission_path).
+        compress: gzip the output (defaults to path ending with '.gz').
+        block_size: the number of rows formatted at once.
+    """
+    def __init__(self, path=None, compress=None, block_size=1000000):
+        path = path or get_paths()["submission_path"]
+        if compress is None:
+            compress = path.endswith(".gz")
+        self.f = gzip.open(path, "wb") if compress else open(path, "wb")
+        self.block_size = block_size
+        self.f.write(b"SearchId,PropertyId\n")
+
+    def write(self, srch_ids, prop_ids, scores, grouped=True):
+        """
+        Write complete searches, each ordered by ascending score.
+
+        Args:
+            srch_ids: array of search ids.
+            prop_ids: array of property ids.
+            scores: array of scores, lower ranks first.
+            grouped: rows of a search are contiguous (see search_order()).
+
+        Returns:
+            None.
+        """
+        order = search_order(srch_ids, scores, grouped)
+        srch_ids = np.asarray(srch_ids)[order]
+        prop_ids = np.asarray(prop_ids)[order]
+        for start in range(0, len(order), self.block_size):
+            end = start + self.block_size
+            lines = map("{},{}\n".format, srch_ids[start:end].tolist(), prop_ids[start:end].tolist())
+            self.f.write("".join(lines).encode("ascii"))
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class ScoreWriter(object):
+    """
+    Write raw (srch_id, prop_id, score) records, SCORE_DTYPE packed with
+    no header, so the file can be memory-mapped by read_scores().
+
+    Args:
+        path: output path.
+    """
+    def __init__(self, path):
+        self.f = open(path, "wb")
+
+    def write(self, srch_ids, prop_ids, scores):
+        records = np.empty(len(srch_ids), dtype=SCORE_DTYPE)
+        records["srch_id"] = srch_ids
+        records["prop_id"] = prop_ids
+        records["score"] = scores
+        records.tofile(self.f)
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def read_scores(path):
+    """
+    Memory-map a score file written by ScoreWriter.
+    """
+    return np.memmap(path, dtype=SCORE_DTYPE, mode="r")
+
+def record_blocks(recommendations, block_size):
+    """
+    Read an iterable of (srch_id, prop_id, score) in blocks of block_size
+    rows, as (srch_ids, prop_ids, scores) arrays.
+    """
+    recommendations = iter(recommendations)
+    while True:
+        block = list(itertools.islice(recommendations, block_size))
+        if not block:
+            return
+        srch_ids, prop_ids, scores = zip(*block)
+        yield np.array(srch_ids, dtype=np.int64), np.array(prop_ids, dtype=np.int64), np.array(scores, dtype=float)
+
+def write_submission(recommendations, submission_file=None, grouped=False, compress=None, block_size=1000000):
+    """
+    Write the submission ordered by srch_id and ascending score.
+
+    With grouped set, the records are read and written block_size rows at
+    a time; the last search of a block is held back until the next block,
+    since it may continue there. Otherwise the rows have to be sorted by
+    srch_id first, so the blocks are gathered into compact arrays.
+
+    Args:
+        recommendations: iterable of (srch_id, prop_id, score).
+        submission_file: output path (defaults to SETTINGS.json's submission_path).
+        grouped: rows of a search are already contiguous.
+        compress: gzip the output (defaults to path ending with '.gz').
+        block_size: the number of rows read and written at once.
+
+    Returns:
+        None.
+    """
+    blocks = record_blocks(recommendations, block_size)
+    with SubmissionWriter(submission_file, compress, block_size) as writer:
+        if not grouped:
+            blocks = list(blocks)
+            if blocks:
+                writer.write(*[np.concatenate(arrays) for arrays in zip(*blocks)], grouped=False)
+            return
+        carry = None
+        for block in blocks:
+            if carry is not None:
+                block = [np.r_[kept, new] for kept, new in zip(carry, block)]
+            other = np.flatnonzero(block[0] != block[0][-1])
+            end = other[-1] + 1 if len(other) else 0
+            writer.write(*[arrays[:end] for arrays in block], grouped=True)
+            carry = [arrays[end:] for arrays in block]
+        if carry is not None:
+            writer.write(*carry, grouped=True)
 
 def main():
     print('Reading file sizes')
@@ -1,4 +1,5 @@
-import data_import
+import cache
+import stats_engine
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
@@ -97,9 +98,10 @@ def nan_percent(train, feature_name):
     plt.show()
     train.drop(labels = [feature_nan_name], axis = 1, inplace = True)
 
-## Load data
-train = data_import.load_train()
-test = data_import.load_test()
+## Load data: a slice for the row-level plots, one-pass statistics of the whole training file for the rest
+train = cache.load_raw("train")
+test = cache.load_raw("test")
+stats = stats_engine.summarize("train")
 
 ## features count across datatype
 dataTypeDf = pd.DataFrame(train.dtypes.value_counts()).reset_index().rename(columns={"index":"variableType",0:"count"})
@@ -110,8 +112,10 @@ ax.set(xlabel='Variable Type', ylabel='Count',title="Variables Count Across Data
 plt.show()
 
 ## feature completeness
-missingValueColumns = train.columns[train.isnull().any()].tolist()
-msno.bar(train[missingValueColumns], figsize=(20, 8),color="#34495e",fontsize=12,labels=True,)
+completeness = 1 - stats.null_count() / stats.rows
+missingValueColumns = completeness.index[completeness < 1].tolist()
+completeness[missingValueColumns].plot.bar(figsize=(20, 8), color="#34495e", fontsize=12)
+plt.show()
 msno.matrix(train[missingValueColumns],width_ratios=(10, 1), figsize=(20, 8),color=(0, 0, 0),fontsize=12,sparkline=True,labels=True)
 
 ## relatioships between two outcomes by crosstab
@@ -126,9 +130,9 @@ len(set(test['prop_id'].unique()) & set(train['prop_id'].unique()))
 plot_discrete_1d(train, "prop_review_score")
 plot_discrete_2d(train, "prop_review_score")
 
-train[['prop_review_score', 'booking_bool']].groupby(['prop_review_score'], as_index=False).mean().sort_values(by='prop_review_score', ascending=False)
+stats.category_rates('prop_review_score').sort_index(ascending=False)
 
-train[['prop_review_score', 'booking_bool']].groupby(['prop_review_score']).mean().plot.bar()
+stats.category_rates('prop_review_score')[['booking_bool']].plot.bar()
 plt.show()
 
 sns.countplot('prop_review_score',hue='booking_bool',data=train)
@@ -140,14 +144,14 @@ plot_continous_1d(train, "prop_location_score2")
 plot_continous_2d(train, "prop_location_score2")
 
 ## 'prop_location_score2' correlation with other features
-train.drop(['date_time'], axis=1).astype(float).corr()['prop_location_score2'].abs().sort_values(ascending=False)[1:10]
+stats.corr()['prop_location_score2'].abs().sort_values(ascending=False)[1:10]
 
 ## 'prop_location_score2' correlation map under booking vs non-booking behavior
-train[train['booking_bool']==1].drop(['date_time'], axis=1).astype(float).corr()['prop_location_score2'].abs().sort_values(ascending=False)[1:10]
-train[train['booking_bool']==0].drop(['date_time'], axis=1).astype(float).corr()['prop_location_score2'].abs().sort_values(ascending=False)[1:10]
+stats.corr(given=1)['prop_location_score2'].abs().sort_values(ascending=False)[1:10]
+stats.corr(given=0)['prop_location_score2'].abs().sort_values(ascending=False)[1:10]
 
 ## correlation matrix for all features except 'date_time'
-g = sns.heatmap(train.drop(['date_time'], axis=1).astype(float).corr(),annot=True, fmt = ".2f", cmap = "YlGnBu")
+g = sns.heatmap(stats.corr(),annot=True, fmt = ".2f", cmap = "YlGnBu")
 g.set_yticklabels(g.get_yticklabels(), rotation=0, fontsize=5)
 g.set_xticklabels(g.get_xticklabels(), rotation=270, fontsize=5)
 plt.show()
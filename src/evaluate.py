@@ -0,0 +1,169 @@
+import data_import
+import cache
+import scoring
+import profiling
+import numpy as np
+
+def relevance(booking_bool, click_bool):
+    """
+    Relevance grade of each row: 5 if booked, 1 if only clicked, 0 otherwise.
+    """
+    return np.where(np.asarray(booking_bool) == 1, 5, np.where(np.asarray(click_bool) == 1, 1, 0))
+
+def search_starts(srch_ids):
+    """
+    Find where each run of equal srch_id starts.
+
+    Args:
+        srch_ids: array of search ids, rows of a search contiguous.
+
+    Returns:
+        (start offset of each search, search number of each row).
+    """
+    srch_ids = np.asarray(srch_ids)
+    new_search = np.r_[True, srch_ids[1:] != srch_ids[:-1]]
+    return np.flatnonzero(new_search), np.cumsum(new_search) - 1
+
+def ndcg_per_search(srch_ids, rel, scores, k=38, grouped=False):
+    """
+    nDCG@k of every search with gain 2^rel - 1 and discount 1 / log2(rank + 1).
+
+    Everything is computed on flat arrays with search offsets and no sort
+    by score: only rows with a gain need their rank, which is the number
+    of rows of the same search scored higher (ties keep row order), read
+    from a (searches x max search size) matrix of scores. The ideal DCG
+    comes from counting the rows of each relevance grade.
+
+    Args:
+        srch_ids: array of search ids.
+        rel: array of relevance grades (small non-negative integers).
+        scores: array of scores, higher ranks first.
+        k: cut-off rank.
+        grouped: rows of a search are already contiguous.
+
+    Returns:
+        (search ids, nDCG of each search); searches without any relevant
+        row score 0.
+    """
+    srch_ids, rel, scores = np.asarray(srch_ids), np.asarray(rel), np.asarray(scores, dtype=float)
+    if not grouped:
+        order = np.argsort(srch_ids, kind="mergesort")
+        srch_ids, rel, scores = srch_ids[order], rel[order], scores[order]
+    starts, search = search_starts(srch_ids)
+    position = np.arange(len(srch_ids)) - starts[search]
+
+    ## scores laid out one search per row, padded with -inf
+    padded = np.full((len(starts), position.max() + 1 if len(position) else 0), -np.inf)
+    padded[search, position] = scores
+
+    ## rank of the relevant rows within their search
+    relevant = np.flatnonzero(rel > 0)
+    candidates = padded[search[relevant]]
+    own = scores[relevant][:,None]
+    before = np.arange(padded.shape[1])[None,:] < position[relevant][:,None]
+    rank = (candidates > own).sum(axis=1) + ((candidates == own) & before).sum(axis=1)
+
+    gain = np.power(2.0, rel[relevant]) - 1
+    discount = np.where(rank < k, 1.0 / np.log2(rank + 2.0), 0.0)
+    dcg = np.bincount(search[relevant], weights=gain * discount, minlength=len(starts))
+
+    ## ideal DCG: the rows of grade >= g fill the first ranks, so each
+    ## grade adds its gain step over the previous grade on those ranks
+    cum_discount = np.r_[0.0, np.cumsum(1.0 / np.log2(np.arange(k) + 2.0))]
+    idcg = np.zeros(len(starts))
+    previous_gain = 0.0
+    for grade in np.unique(rel[relevant]):
+        at_least = np.bincount(search[relevant], weights=rel[relevant] >= grade, minlength=len(starts)).astype(int)
+        idcg += (2.0 ** grade - 1 - previous_gain) * cum_discount[np.minimum(at_least, k)]
+        previous_gain = 2.0 ** grade - 1
+    with np.errstate(invalid="ignore", divide="ignore"):
+        per_search = np.where(idcg > 0, dcg / idcg, 0.0)
+    return srch_ids[starts], per_search
+
+def ndcg(srch_ids, rel, scores, k=38, grouped=False):
+    """
+    Mean nDCG@k over searches (see ndcg_per_search()).
+    """
+    return ndcg_per_search(srch_ids, rel, scores, k, grouped)[1].mean()
+
+def evaluate_frame(df, scores, k=38):
+    """
+    Mean nDCG@k of scores on a data object holding 'booking_bool' and 'click_bool'.
+    """
+    return ndcg(df["srch_id"].values, relevance(df["booking_bool"].values, df["click_bool"].values), scores, k)
+
+def holdout_split(df, test_size=0.2, random_state=42):
+    """
+    Split a data object into training and holdout parts by whole searches.
+
+    Args:
+        df: data object.
+        test_size: fraction of searches held out.
+        random_state: seed of the split.
+
+    Returns:
+        (training part, holdout part).
+    """
+    srch_ids = np.unique(df["srch_id"].values)
+    rng = np.random.RandomState(random_state)
+    holdout_ids = srch_ids[rng.rand(len(srch_ids)) < test_size]
+    in_holdout = np.in1d(df["srch_id"].values, holdout_ids)
+    return df[~in_holdout], df[in_holdout]
+
+def unfitted_searches(df, transformer):
+    """
+    Rows of the searches the saved models were not fitted on.
+
+    Training records the fitted search ids on the transformer; rows of
+    older transformers are all returned, with a warning.
+
+    Raises:
+        ValueError: every search of df was fitted.
+    """
+    fitted = getattr(transformer, "fitted_srch_ids_", None)
+    if fitted is None:
+        print("Warning: the transformer does not record the fitted searches, the holdout may overlap them")
+        return df
+    unfitted = df[~np.in1d(df["srch_id"].values, fitted)]
+    if not len(unfitted):
+        raise ValueError("every search was fitted; set sample_rows to keep searches out of training")
+    return unfitted
+
+def validate(fit_score, df, test_size=0.2, random_state=42, k=38):
+    """
+    Holdout nDCG of a training procedure.
+
+    Args:
+        fit_score: function(train part, holdout part) returning the scores
+            of the holdout rows (higher ranks first).
+        df: labelled data object.
+        test_size: fraction of searches held out.
+        random_state: seed of the split.
+        k: cut-off rank.
+
+    Returns:
+        mean nDCG@k on the holdout searches.
+    """
+    train, holdout = holdout_split(df, test_size, random_state)
+    return evaluate_frame(holdout, fit_score(train, holdout), k)
+
+def main():
+    paths = data_import.get_paths()
+    profiling.configure(paths)
+    scoring.init_scorer()
+    _, holdout = holdout_split(unfitted_searches(cache.load_raw("train", nrows=None), scoring._scorer["transformer"]))
+
+    print("Scoring {} holdout rows with the saved classifiers..".format(len(holdout)))
+    with profiling.stage("score holdout") as span:
+        _, _, scores = scoring.score_chunk(holdout)
+        span.rows = len(holdout)
+
+    print("Evaluating nDCG@38..")
+    with profiling.stage("ndcg") as span:
+        print("Model:  {:.4f}".format(evaluate_frame(holdout, -scores)))
+        print("Random: {:.4f}".format(evaluate_frame(holdout, np.random.rand(len(holdout)))))
+        span.rows = len(holdout)
+    profiling.save_trace(paths, "evaluate")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,740 @@
+import pandas as pd
+import numpy as np
+from collections import OrderedDict
+from data_import import DATE_FORMAT
+from binning import BinMapper
+from profiling import stage
+from sampling import search_priority
+from stats_index import StatsIndex, load_indexes, join_indexes
+from stats_engine import StreamingStats, summarize
+
+COMP_RATE_NAMES = ['comp'+str(i)+'_rate' for i in range(1,9)]
+COMP_INV_NAMES = ['comp'+str(i)+'_inv' for i in range(1,9)]
+
+## date parts extracted from 'date_time'
+DATE_PARTS = ["month", "day", "hour", "minute", "dayofweek", "quarter"]
+
+## features that only depend on the search, in the order they are added
+SEARCH_FEATURES = ["visitor_hist_starrating_bool"] + DATE_PARTS + ["visitor_location_country_bool"]
+
+def outlier_bounds(train, feature_name):
+    """
+    Find 0.05 and 0.95 quantiles of a feature.
+
+    Args:
+        train: data object.
+        feature_name: feature name.
+
+    Returns:
+        (lower bound, upper bound).
+    """
+    return train[feature_name].quantile(.05), train[feature_name].quantile(.95)
+
+def outlier_handler(train, feature_name, bounds=None):
+    """
+    Truncate outlier by 0.05 of data as lower bound and
+    0.95 of data as upper bound.
+
+    Args:
+        train: data object.
+        feature_name: feature name (e.g. 'booking_bool').
+        bounds: precomputed (lower bound, upper bound), if any.
+
+    Returns:
+        None.
+    """
+    lb, ub = bounds if bounds is not None else outlier_bounds(train, feature_name)
+    train.loc[train[feature_name] > ub, feature_name] = ub
+    train.loc[train[feature_name] < lb, feature_name] = lb
+
+def support_fill_value(train, feature_name):
+    """
+    Draw the value used to impute the support of a feature.
+
+    Args:
+        train: data object.
+        feature_name: target feature name with nan.
+
+    Returns:
+        random value around the mean of the feature.
+    """
+    return draw_fill_value(train[feature_name].mean(), train['prop_location_score1'].std(), train[feature_name].dtype)
+
+def draw_fill_value(feature_support_avg, feature_support_std, dtype):
+    """
+    Draw a value within one std of a mean, of the given dtype's kind.
+    """
+    if np.issubdtype(dtype, np.floating):
+        feature_support_null_random_list = np.random.uniform(feature_support_avg - feature_support_std, feature_support_avg + feature_support_std, 1)
+    if np.issubdtype(dtype, np.integer):
+        feature_support_null_random_list = np.random.randint(feature_support_avg - feature_support_std, feature_support_avg + feature_support_std, 1)
+    return feature_support_null_random_list[0]
+
+def add_counts(counts, values):
+    """
+    Add the value counts of an array to those of earlier arrays (None at first).
+    """
+    new = pd.Series(values).value_counts()
+    return new if counts is None else counts.add(new, fill_value=0)
+
+def counts_median(counts):
+    """
+    Median of the values counted by add_counts(), as Series.median().
+    """
+    counts = counts.sort_index()
+    cumulative = counts.values.cumsum()
+    if not len(cumulative):
+        return np.nan
+    n = cumulative[-1]
+    lower = counts.index[np.searchsorted(cumulative, (n - 1) // 2, side="right")]
+    upper = counts.index[np.searchsorted(cumulative, n // 2, side="right")]
+    return (lower + upper) / 2.0
+
+def impute_with_best_support(train, feature_name, feature_support_name, fill_value=None):
+    """
+    Impute the feature with with its most correlated feature.
+
+    Args:
+        train: data object.
+        feature_name: target feature name with nan.
+        feature_support_name: most correlated feature
+        fill_value: precomputed imputation value, if any.
+
+    Returns:
+        None.
+    """
+    if fill_value is None:
+        fill_value = support_fill_value(train, feature_name)
+    train[feature_support_name] = train[feature_support_name].fillna(fill_value)
+
+def best_support(train, feature_name, summary=None):
+    """
+    Find the feature with the largest absolute correlation to the given feature.
+
+    Only the correlation vector of 'feature_name' is computed (pairwise
+    complete, as in DataFrame.corr()) instead of the full matrix.
+
+    Args:
+        train: data object.
+        feature_name: feature name.
+        summary: if given, StreamingStats of the whole training file (see
+            stats_engine.py) whose correlations are used instead; only
+            the columns of train it holds are candidates.
+
+    Returns:
+        name of the most correlated feature.
+    """
+    if summary is not None:
+        return summary.best_support(feature_name, list(train.columns.drop('date_time')))
+    y = train[feature_name].values.astype(float)
+    y_valid = ~np.isnan(y)
+    support_name, support_corr = feature_name, -1.0
+    for name in train.columns.drop('date_time'):
+        x = train[name].values.astype(float)
+        valid = y_valid & ~np.isnan(x)
+        if valid.sum() < 2:
+            continue
+        xd = x[valid] - x[valid].mean()
+        yd = y[valid] - y[valid].mean()
+        denom = np.sqrt(np.dot(xd, xd) * np.dot(yd, yd))
+        if denom == 0:
+            continue
+        corr = abs(np.dot(xd, yd) / denom)
+        if corr > support_corr:
+            support_name, support_corr = name, corr
+    return support_name
+
+def popular_destinations(train, feature_name):
+    """
+    Find the destinations in the top quarter of click rate.
+    """
+    df = train.groupby([feature_name])["click_bool"].mean().sort_values(ascending=False).to_frame().reset_index()
+    df['popular_bool'] = pd.cut(df["click_bool"], df['click_bool'].quantile([.0, .75, 1]), labels=['not popular', 'popular'])
+    return df.loc[df['popular_bool']=='popular', feature_name].values
+
+def pop_dest_finder(train, feature_name, destinations=None, index=None):
+    """
+    Find the most popular destinations and make it as boolean.
+
+    Args:
+        train: data object.
+        feature_name: destination feature name.
+        destinations: precomputed popular destinations, if any.
+        index: StatsIndex of the destinations, read instead of grouping
+            the data object if given.
+
+    Returns:
+        popular destinations.
+    """
+    if destinations is None and index is not None:
+        destinations = index.top_keys("clicks", 0.75)
+    elif destinations is None:
+        destinations = popular_destinations(train, feature_name)
+    train['popular_destination_bool'] = 0
+    train.loc[train['srch_destination_id'].isin(destinations) , 'popular_destination_bool'] = 1
+    return destinations
+
+class SearchCache(object):
+    """
+    LRU cache of search-level feature values, keyed by the fields they are
+    computed from: the minute of 'date_time', whether the visitor has a
+    star rating history and whether the visitor is from the most common
+    country. Searches sharing these share their features whatever their
+    srch_id, so live traffic hits the cache within the same minute.
+
+    Args:
+        maxsize: the number of searches kept.
+    """
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+def parse_dates(values):
+    """
+    Parse 'date_time' values with the fixed raw format, each distinct
+    string once; already parsed values are returned as they are.
+    """
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.datetime64):
+        return values
+    distinct, inverse = np.unique(values.astype(str), return_inverse=True)
+    return pd.to_datetime(distinct, format=DATE_FORMAT).values[inverse]
+
+def search_features(starrating, dates, country, visitor_country):
+    """
+    Search-level features of one row per search.
+
+    Args:
+        starrating: 'visitor_hist_starrating' of every search.
+        dates: parsed 'date_time' of every search.
+        country: 'visitor_location_country_id' of every search.
+        visitor_country: the most common visitor country.
+
+    Returns:
+        dict of feature name to array, in SEARCH_FEATURES order.
+    """
+    features = OrderedDict()
+    features["visitor_hist_starrating_bool"] = pd.notnull(starrating) * 1
+    dates = pd.DatetimeIndex(dates)
+    for prop in DATE_PARTS:
+        features[prop] = np.asarray(getattr(dates, prop))
+    features["visitor_location_country_bool"] = np.where(country==visitor_country, 1, 0)
+    return features
+
+def search_feature_rows(ids, starrating, date_time, country, visitor_country, cache=None):
+    """
+    Compute the search-level features once per search and broadcast them
+    to its rows.
+
+    'date_time', the visitor fields and the other search fields repeat on
+    every candidate row of a search, so only the first row of each run of
+    equal srch_id is engineered.
+
+    Args:
+        ids: 'srch_id' of every row.
+        starrating: 'visitor_hist_starrating' of every row.
+        date_time: raw or parsed 'date_time' of every row.
+        country: 'visitor_location_country_id' of every row.
+        visitor_country: the most common visitor country.
+        cache: SearchCache consulted before computing a search, if any.
+
+    Returns:
+        (parsed 'date_time' of every row, dict of feature name to array).
+    """
+    new_search = np.r_[True, ids[1:] != ids[:-1]] if len(ids) else np.zeros(0, dtype=bool)
+    starts, run = np.flatnonzero(new_search), np.cumsum(new_search) - 1
+    starrating, country = starrating[starts], country[starts]
+    dates = parse_dates(np.asarray(date_time)[starts])
+
+    if cache is None:
+        features = search_features(starrating, dates, country, visitor_country)
+    else:
+        keys = list(zip(dates.astype("datetime64[m]").astype(np.int64).tolist(),
+            pd.notnull(starrating).tolist(), (country == visitor_country).tolist()))
+        cached = [cache.get(key) for key in keys]
+        missing = [i for i, value in enumerate(cached) if value is None]
+        if missing:
+            computed = search_features(starrating[missing], dates[missing], country[missing], visitor_country)
+            for j, i in enumerate(missing):
+                cached[i] = tuple(values[j] for values in computed.values())
+                cache.put(keys[i], cached[i])
+        features = OrderedDict((name, np.array([value[f] for value in cached])) for f, name in enumerate(SEARCH_FEATURES))
+    return dates[run], OrderedDict((name, values[run]) for name, values in features.items())
+
+def add_search_features(train, visitor_country, cache=None):
+    """
+    Add the search-level features (see search_feature_rows()) to a data
+    object and parse its 'date_time', in place.
+
+    Args:
+        train: data object.
+        visitor_country: the most common visitor country.
+        cache: SearchCache consulted before computing a search, if any.
+
+    Returns:
+        None.
+    """
+    dates, features = search_feature_rows(train['srch_id'].values, train['visitor_hist_starrating'].values,
+        train['date_time'].values, train['visitor_location_country_id'].values, visitor_country, cache)
+    train['date_time'] = dates
+    for name, values in features.items():
+        train[name] = values
+
+def check_nan_values(train):
+    """
+    Check if the data has nan.
+    """
+    nan_value_number = train.isnull().values.sum()
+    if nan_value_number == 0:
+      print("Success: there is no nan value")
+    else:
+      print("Error: there are {} nan values".format(nan_value_number))
+
+class FeatureTransformer(object):
+    """
+    Feature engineering split into fit and transform.
+
+    fit() learns the data-dependent statistics (medians, quantiles, most
+    common country, support columns, imputation values) on the training
+    set; transform() only does per-row work with them, so any batch is
+    engineered consistently with the training set.
+
+    Args:
+        pop_dest: also learn the popular destinations and add
+            'popular_destination_bool' (needs 'click_bool' at fit time).
+        stats_path: if given, the StatsIndex file (see stats_index.py)
+            loaded at fit time; its property and destination statistics
+            are joined to every row.
+        use_summary: choose the support columns from the cached summary
+            of the whole training file (stats_engine.summarize()) instead
+            of the rows being fitted.
+    """
+    def __init__(self, pop_dest=False, stats_path=None, use_summary=False):
+        self.pop_dest = pop_dest
+        self.stats_path = stats_path
+        self.use_summary = use_summary
+
+    def fit(self, train):
+        """
+        Learn the statistics on a copy of the data object.
+        """
+        self.fit_transform(train.copy())
+        return self
+
+    def fit_transform(self, train):
+        """
+        Learn the statistics and engineer the data object in place.
+
+        Each statistic is learned at the same step of the pipeline as it
+        is used, so the result equals the original one-shot feature_eng().
+        """
+        with stage("rows"):
+            self.review_score_median_ = train['prop_review_score'].median()
+            self.visitor_country_ = train['visitor_location_country_id'].value_counts().index[0]
+            self._transform_rows(train)
+
+        summary = summarize("train") if getattr(self, "use_summary", False) else None
+
+        with stage("affinity"):
+            self.affinity_support_ = best_support(train, 'srch_query_affinity_score', summary)
+            self.affinity_fill_ = support_fill_value(train, 'srch_query_affinity_score')
+            impute_with_best_support(train, 'srch_query_affinity_score', self.affinity_support_, self.affinity_fill_)
+            self.affinity_bounds_ = outlier_bounds(train, 'srch_query_affinity_score')
+            outlier_handler(train, 'srch_query_affinity_score', self.affinity_bounds_)
+
+        with stage("distance"):
+            self.distance_support_ = best_support(train, 'orig_destination_distance', summary)
+            self.distance_fill_ = support_fill_value(train, 'prop_location_score1')
+            impute_with_best_support(train, 'prop_location_score1', self.distance_support_, self.distance_fill_)
+
+        with stage("competitors"):
+            self._transform_competitors(train)
+
+        self.stats_ = load_indexes(self.stats_path)[0] if self.stats_path else None
+        if self.stats_ is not None:
+            ## the training rows are part of the indexed history
+            with stage("stats index"):
+                join_indexes(train, self.stats_, exclude_self=True)
+
+        self.popular_destinations_ = None
+        if self.pop_dest:
+            with stage("popular destinations"):
+                index = self.stats_["dest"] if self.stats_ is not None else None
+                self.popular_destinations_ = pop_dest_finder(train, 'srch_destination_id', index=index)
+        self.feature_names_ = get_features(train)
+
+    def fit_stream(self, chunks, sample_rows=200000, random_state=42):
+        """
+        Learn the statistics on a whole data set streamed in chunks, e.g.
+        one the rows being engineered were sampled from.
+
+        As in fit_transform(), each statistic is learned on the rows as
+        engineered by the steps before it, with one pass per step: the
+        median and the most common country from value counts, the support
+        columns and imputation values from StreamingStats of the engineered
+        chunks (see stats_engine.py) and the outlier bounds from their
+        quantile sample. The bin edges (see fit_bins()) are learned on a
+        uniform sample of sample_rows rows.
+
+        Args:
+            chunks: function returning a new iterable of data objects of
+                the set (e.g. lambda: data_import.read_chunks(path)).
+            sample_rows: the number of rows the bin edges are learned on.
+            random_state: seed of the row sample.
+        """
+        with stage("counts"):
+            review_scores = countries = None
+            destinations = StatsIndex("srch_destination_id", "dest") if self.pop_dest and not self.stats_path else None
+            for chunk in chunks():
+                review_scores = add_counts(review_scores, chunk['prop_review_score'].values)
+                countries = add_counts(countries, chunk['visitor_location_country_id'].values)
+                if destinations is not None:
+                    destinations.update(chunk)
+            self.review_score_median_ = counts_median(review_scores)
+            self.visitor_country_ = countries.sort_values(ascending=False, kind="mergesort").index[0].astype(chunk['visitor_location_country_id'].dtype)
+
+        summary = summarize("train") if getattr(self, "use_summary", False) else None
+
+        with stage("affinity"):
+            stats = StreamingStats(condition=None)
+            for chunk in chunks():
+                self._transform_rows(chunk)
+                stats.update(chunk)
+            candidates = list(chunk.columns.drop('date_time'))
+            name = 'srch_query_affinity_score'
+            self.affinity_support_ = (summary or stats).best_support(name, candidates)
+            self.affinity_fill_ = draw_fill_value(stats.mean()[name], stats.std()['prop_location_score1'], chunk[name].dtype)
+            values = stats.sketch[name][0]
+            if self.affinity_support_ == name:
+                ## the missing values are imputed before the bounds are taken
+                nulls = stats.null_count()[name]
+                values = np.r_[values, np.full(int(round(len(values) * nulls / max(stats.rows - nulls, 1))), self.affinity_fill_)]
+            self.affinity_bounds_ = tuple(np.percentile(values, [5, 95])) if len(values) else (np.nan, np.nan)
+
+        with stage("distance"):
+            stats = StreamingStats(condition=None)
+            sample, priorities, start = None, np.zeros(0), 0
+            for chunk in chunks():
+                ## bottom-k of the rows by a hash of the row number, kept raw
+                priority = search_priority(np.arange(start, start + len(chunk)), random_state)
+                start += len(chunk)
+                keep = priority < priorities.max() if len(priorities) >= sample_rows else np.ones(len(chunk), dtype=bool)
+                sample = pd.concat([sample, chunk[keep]]) if sample is not None else chunk[keep]
+                priorities = np.r_[priorities, priority[keep]]
+                if len(priorities) > sample_rows:
+                    top = np.sort(np.argpartition(priorities, sample_rows - 1)[:sample_rows])
+                    sample, priorities = sample.iloc[top], priorities[top]
+
+                self._transform_rows(chunk)
+                impute_with_best_support(chunk, name, self.affinity_support_, self.affinity_fill_)
+                outlier_handler(chunk, name, self.affinity_bounds_)
+                stats.update(chunk)
+            self.distance_support_ = (summary or stats).best_support('orig_destination_distance', candidates)
+            self.distance_fill_ = draw_fill_value(stats.mean()['prop_location_score1'], stats.std()['prop_location_score1'],
+                chunk['prop_location_score1'].dtype)
+
+        self.stats_ = load_indexes(self.stats_path)[0] if self.stats_path else None
+        self.popular_destinations_ = None
+        if self.pop_dest:
+            index = self.stats_["dest"] if self.stats_ is not None else destinations
+            self.popular_destinations_ = index.top_keys("clicks", 0.75)
+
+        with stage("bins") as span:
+            sample = sample.copy()
+            self.transform(sample)
+            self.feature_names_ = get_features(sample)
+            self.fit_bins(sample, subsample=None)
+            span.rows = len(sample)
+        return self
+
+    def transform(self, train, search_cache=None):
+        """
+        Engineer the data object in place with the learned statistics.
+
+        Args:
+            train: data object.
+            search_cache: SearchCache of the search-level features, if any.
+        """
+        self._transform_rows(train, search_cache)
+
+        impute_with_best_support(train, 'srch_query_affinity_score', self.affinity_support_, self.affinity_fill_)
+        outlier_handler(train, 'srch_query_affinity_score', self.affinity_bounds_)
+        impute_with_best_support(train, 'prop_location_score1', self.distance_support_, self.distance_fill_)
+
+        self._transform_competitors(train)
+
+        if getattr(self, "stats_", None) is not None:
+            join_indexes(train, self.stats_, exclude_self="click_bool" in train.columns)
+
+        if self.popular_destinations_ is not None:
+            pop_dest_finder(train, 'srch_destination_id', self.popular_destinations_)
+
+    def update(self, train):
+        """
+        Merge a labelled batch into the statistics that can be merged: the
+        stats index and the popular destinations read from it.
+
+        The other learned values (medians, bounds, support columns, bin
+        edges) stay as fitted, so models trained on earlier batches keep
+        seeing the same features.
+        """
+        if getattr(self, "stats_", None) is None:
+            return self
+        for index in self.stats_.values():
+            index.update(train)
+        if self.popular_destinations_ is not None:
+            self.popular_destinations_ = self.stats_["dest"].top_keys("clicks", 0.75)
+        return self
+
+    ## learned values saved by to_artifact(): numbers and tuples as arrays, names in the meta
+    VALUES = ["review_score_median_", "visitor_country_", "affinity_support_", "affinity_fill_", "affinity_bounds_",
+        "distance_support_", "distance_fill_", "feature_names_", "refreshed_sources_"]
+    ## learned arrays saved as they are, if set
+    ARRAYS = ["popular_destinations_", "fitted_srch_ids_"]
+
+    def to_artifact(self):
+        """
+        The parameters and learned state as named arrays and json-serializable
+        meta values, for a model artifact (see artifact.save_artifact()).
+
+        The bin edges are concatenated with the offset of every feature and
+        every stats index sum gets its own array, so nothing is pickled.
+
+        Returns:
+            (dict of name to array, dict of meta values).
+        """
+        arrays = {}
+        meta = {"params": {"pop_dest": self.pop_dest, "stats_path": self.stats_path,
+            "use_summary": getattr(self, "use_summary", False)}, "values": {}, "tuples": []}
+        for name in self.VALUES:
+            value = getattr(self, name, None)
+            if value is None:
+                continue
+            if isinstance(value, (str, list)):
+                meta["values"][name] = value
+            else:
+                arrays[name] = np.atleast_1d(value)
+                if isinstance(value, tuple):
+                    meta["tuples"].append(name)
+        for name in self.ARRAYS:
+            if getattr(self, name, None) is not None:
+                arrays[name] = np.asarray(getattr(self, name))
+        bin_mapper = getattr(self, "bin_mapper_", None)
+        if bin_mapper is not None:
+            arrays["bin_edges"] = np.concatenate(bin_mapper.edges_ + [np.zeros(0)])
+            arrays["bin_offsets"] = np.cumsum([0] + [len(edges) for edges in bin_mapper.edges_])
+            meta["bin_mapper"] = {"max_bins": bin_mapper.max_bins, "subsample": bin_mapper.subsample,
+                "random_state": bin_mapper.random_state}
+        if getattr(self, "stats_", None) is not None:
+            meta["stats"] = dict((prefix, [index.key, index.smoothing]) for prefix, index in self.stats_.items())
+            for prefix, index in self.stats_.items():
+                arrays["stats__" + prefix + "__keys"] = index.keys
+                for name in StatsIndex.SUMS:
+                    arrays["stats__" + prefix + "__" + name] = getattr(index, name)
+        return arrays, meta
+
+    @classmethod
+    def from_artifact(cls, arrays, meta):
+        """
+        Rebuild a transformer from the output of to_artifact(); the arrays
+        may be memory-mapped.
+        """
+        transformer = cls(**meta["params"])
+        for name, value in meta["values"].items():
+            setattr(transformer, name, value)
+        for name in cls.VALUES:
+            if name in arrays:
+                value = np.asarray(arrays[name])
+                setattr(transformer, name, tuple(value) if name in meta["tuples"] else value[0])
+        transformer.popular_destinations_ = arrays.get("popular_destinations_")
+        if "fitted_srch_ids_" in arrays:
+            transformer.fitted_srch_ids_ = arrays["fitted_srch_ids_"]
+        if "bin_mapper" in meta:
+            transformer.bin_mapper_ = BinMapper(**meta["bin_mapper"])
+            offsets = arrays["bin_offsets"]
+            transformer.bin_mapper_.edges_ = [arrays["bin_edges"][offsets[j]:offsets[j + 1]] for j in range(len(offsets) - 1)]
+        transformer.stats_ = None
+        if "stats" in meta:
+            transformer.stats_ = {}
+            for prefix, (key, smoothing) in meta["stats"].items():
+                index = StatsIndex(key, prefix, smoothing)
+                index.keys = arrays["stats__" + prefix + "__keys"]
+                for name in StatsIndex.SUMS:
+                    setattr(index, name, arrays["stats__" + prefix + "__" + name])
+                transformer.stats_[prefix] = index
+        return transformer
+
+    def fit_bins(self, train, **params):
+        """
+        Learn a BinMapper (see binning.py) on the engineered features of a
+        data object; matrix() applies it from then on.
+        """
+        self.bin_mapper_ = BinMapper(**params).fit(train[self.feature_names_].values)
+        return self
+
+    def matrix(self, train):
+        """
+        Feature matrix of a transformed data object, mapped to bin codes
+        if fit_bins() was called.
+        """
+        feature_names = getattr(self, "feature_names_", None) or get_features(train)
+        X = train[feature_names].values
+        bin_mapper = getattr(self, "bin_mapper_", None)
+        return bin_mapper.transform(X) if bin_mapper is not None else X
+
+    def request_matrix(self, columns, search_cache=None):
+        """
+        Feature matrix of a few unlabelled rows given as column arrays.
+
+        Does the per-row work of transform() followed by matrix() on
+        numpy arrays alone: building and assigning data object columns
+        costs far more than the features themselves on the 25-40 rows of
+        a single search (see serve.py).
+
+        Args:
+            columns: dict of raw column name (data_import.DTYPES) to array.
+            search_cache: SearchCache of the search-level features, if any.
+
+        Returns:
+            feature matrix, like matrix().
+        """
+        data = dict((name, np.asarray(values, dtype=float)) for name, values in columns.items() if name != 'date_time')
+
+        def fill(name, value):
+            data[name] = np.where(np.isnan(data[name]), value, data[name])
+
+        fill('prop_review_score', self.review_score_median_)
+        fill('prop_location_score2', 0)
+        fill('visitor_hist_adr_usd', 0)
+        data.update(search_feature_rows(columns['srch_id'], data['visitor_hist_starrating'], columns['date_time'],
+            data['visitor_location_country_id'], self.visitor_country_, search_cache)[1])
+        data['prop_log_historical_price'] = np.where(data['prop_log_historical_price'] != 0, 1.0, 0.0)
+
+        fill(self.affinity_support_, self.affinity_fill_)
+        lb, ub = self.affinity_bounds_
+        affinity = data['srch_query_affinity_score']
+        data['srch_query_affinity_score'] = np.where(affinity > ub, ub, np.where(affinity < lb, lb, affinity))
+        fill(self.distance_support_, self.distance_fill_)
+
+        rates = np.nan_to_num(np.column_stack([data[name] for name in COMP_RATE_NAMES]))
+        inv = np.nan_to_num(np.column_stack([data[name] for name in COMP_INV_NAMES]))
+        inv = np.select([inv==1, inv==-1, inv==0, inv==10], [0, 1, -1, 0], inv)
+        for i, name in enumerate(COMP_RATE_NAMES):
+            data[name] = rates[:,i]
+        for i, name in enumerate(COMP_INV_NAMES):
+            data[name] = inv[:,i]
+        data['comp_rate_sum'], data['comp_inv_sum'] = rates.sum(axis=1), inv.sum(axis=1)
+
+        if getattr(self, "stats_", None) is not None:
+            for prefix in sorted(self.stats_):
+                index = self.stats_[prefix]
+                data.update(index.columns(columns[index.key]))
+        if self.popular_destinations_ is not None:
+            data['popular_destination_bool'] = np.in1d(columns['srch_destination_id'], self.popular_destinations_) * 1.0
+
+        X = np.column_stack([data[name] for name in self.feature_names_])
+        bin_mapper = getattr(self, "bin_mapper_", None)
+        return bin_mapper.transform(X) if bin_mapper is not None else X
+
+    def _transform_rows(self, train, search_cache=None):
+        ## impute 'prop_review_score' with its median
+        train['prop_review_score'] = train['prop_review_score'].fillna(self.review_score_median_)
+
+        ## impute 'prop_location_score2' with 0
+        train['prop_location_score2'] = train['prop_location_score2'].fillna(0)
+
+        ## impute 'visitor_hist_adr_usd' with 0
+        train['visitor_hist_adr_usd'] = train['visitor_hist_adr_usd'].fillna(0)
+
+        ## once per search: dummy feature for 'visitor_hist_starrating' presence,
+        ## month, day, hour, minute, dayofweek, quarter from 'date_time' and
+        ## the most common visitor country
+        add_search_features(train, self.visitor_country_, search_cache)
+
+        ## smooth 'prop_log_historical_price' with 1
+        train.loc[train['prop_log_historical_price']!=0, 'prop_log_historical_price'] = 1
+
+    def _transform_competitors(self, train):
+        ##  merge 8 competitors' price info
+        rates = train[COMP_RATE_NAMES].values
+        rates[np.isnan(rates)] = 0
+        for i, name in enumerate(COMP_RATE_NAMES):
+            train[name] = rates[:,i]
+        train['comp_rate_sum'] = rates.sum(axis=1)
+
+        ## remap availability: 1 (competitor unavailable) -> 0, -1 -> 1, 0/nan -> -1
+        inv = train[COMP_INV_NAMES].values
+        inv[np.isnan(inv)] = 0
+        inv = np.select([inv==1, inv==-1, inv==0, inv==10], [0, 1, -1, 0], inv).astype(inv.dtype)
+        for i, name in enumerate(COMP_INV_NAMES):
+            train[name] = inv[:,i]
+        train['comp_inv_sum'] = inv.sum(axis=1)
+
+def feature_eng(train, stats_path=None, use_summary=False, stream=None):
+    """
+    Feature engineering for the data set.
+
+    Args:
+        train: data object, engineered in place.
+        stats_path: StatsIndex file joined to the rows, if any.
+        use_summary: choose the support columns from the cached summary
+            of the whole training file.
+        stream: if given, function returning the chunks of the whole set
+            train was sampled from; the statistics are learned on them
+            (see FeatureTransformer.fit_stream()) and train is only
+            transformed.
+
+    Returns:
+        fitted FeatureTransformer.
+    """
+    transformer = FeatureTransformer(stats_path=stats_path, use_summary=use_summary)
+    if stream is None:
+        transformer.fit_transform(train)
+    else:
+        transformer.fit_stream(stream)
+        transformer.transform(train)
+    return transformer
+
+def get_features(train):
+    """
+    Extract the features that will be used for training.
+    """
+    feature_names = list(train.columns)
+    feature_names.remove('date_time')
+    feature_names.remove('site_id')
+    feature_names.remove('visitor_location_country_id')
+    feature_names.remove('prop_country_id')
+    feature_names.remove('srch_destination_id')
+    feature_names.remove("visitor_hist_starrating")
+
+    for i in range(1,9):
+        feature_names.remove('comp'+str(i)+'_rate')
+        feature_names.remove('comp'+str(i)+'_inv')
+        feature_names.remove('comp'+str(i)+'_rate_percent_diff')
+
+    if "position" in feature_names:
+        ## only true in the training set
+        feature_names.remove("position")
+    if "gross_bookings_usd" in feature_names:
+        ## only true in the training set
+        feature_names.remove("gross_bookings_usd")
+    if "click_bool" in feature_names:
+        ## only true in the training set
+        feature_names.remove("click_bool")
+    if "booking_bool" in feature_names:
+        ## only true in the training set
+        feature_names.remove("booking_bool")
+
+    return feature_names
@@ -0,0 +1,204 @@
+import evaluate
+from binning import BinMapper
+import numpy as np
+
+def lambda_gradients(scores, rel, starts, search, position, k=38, block=65536):
+    """
+    LambdaRank gradients and hessians of NDCG@k for every row.
+
+    Only pairs with a relevant row on the upper side carry a gradient, so
+    each relevant row is compared with a row of a (searches x max search
+    size) matrix of scores holding its search, like ndcg_per_search().
+    The pair weights |delta NDCG| * sigmoid(s_j - s_i) are added back to
+    both rows of the pair with bincount.
+
+    Args:
+        scores: current scores, rows grouped by search.
+        rel: relevance grades.
+        starts: start offset of each search.
+        search: search number of each row.
+        position: position of each row within its search.
+        k: NDCG cut-off rank.
+        block: the number of relevant rows handled at once.
+
+    Returns:
+        (gradient, hessian) arrays.
+    """
+    n_searches, width = len(starts), position.max() + 1
+    flat = search * width + position
+    S = np.full(n_searches * width, -np.inf)
+    R = np.zeros(n_searches * width)
+    S[flat] = scores
+    R[flat] = rel
+    S, R = S.reshape(n_searches, width), R.reshape(n_searches, width)
+    valid = np.isfinite(S)
+
+    ## current rank within each search and the ideal DCG
+    order = np.argsort(-S, axis=1, kind="mergesort")
+    rank = np.empty_like(order)
+    rank[np.arange(n_searches)[:,None], order] = np.arange(width)
+    discount = np.where(rank < k, 1.0 / np.log2(rank + 2.0), 0.0)
+    gain = np.power(2.0, R) - 1
+    ideal = -np.sort(-gain, axis=1)[:,:k]
+    idcg = (ideal / np.log2(np.arange(ideal.shape[1]) + 2.0)).sum(axis=1)
+
+    grad = np.zeros(n_searches * width)
+    hess = np.zeros(n_searches * width)
+    relevant = np.flatnonzero(rel > 0)
+    for b in range(0, len(relevant), block):
+        rows = relevant[b:b+block]
+        srch = search[rows]
+        s_i, g_i, d_i = scores[rows][:,None], gain[srch, position[rows]][:,None], discount[srch, position[rows]][:,None]
+        pairs = (R[srch] < rel[rows][:,None]) & valid[srch]
+        with np.errstate(over="ignore"):
+            rho = 1.0 / (1.0 + np.exp(np.minimum(s_i - S[srch], 50)))
+        delta = np.abs((g_i - gain[srch]) * (d_i - discount[srch])) / idcg[srch][:,None]
+        w = np.where(pairs, rho * delta, 0.0)
+        h = np.where(pairs, rho * (1 - rho) * delta, 0.0)
+        ## the relevant row is pushed up, the other row of the pair down
+        index = (srch * width)[:,None] + np.arange(width)[None,:]
+        grad += np.bincount(index.ravel(), w.ravel(), len(grad))
+        hess += np.bincount(index.ravel(), h.ravel(), len(hess))
+        grad -= np.bincount(flat[rows], w.sum(axis=1), len(grad))
+        hess += np.bincount(flat[rows], h.sum(axis=1), len(hess))
+    return grad[flat], hess[flat]
+
+class LambdaRankModel(object):
+    """
+    Listwise ranker: gradient-boosted trees fitted to LambdaRank gradients.
+
+    One model is trained directly on srch_id groups for NDCG@38, replacing
+    the separate booking and click classifiers. Trees are grown level by
+    level on uint8 histogram bins (a BinMapper), so split finding only
+    needs per-bin gradient sums. Split thresholds are stored as raw feature
+    values, so predict() works on the unbinned feature matrix; on a matrix
+    that is already binned the mapper keeps one bin per code.
+
+    Args:
+        n_estimators: the number of boosting rounds.
+        learning_rate: shrinkage of every tree.
+        max_depth: depth of every tree.
+        min_samples_leaf: the minimum number of rows per leaf.
+        max_bins: the maximum number of histogram bins per feature.
+        l2: L2 regularization of the leaf values.
+        k: NDCG cut-off rank.
+    """
+    def __init__(self, n_estimators=100, learning_rate=0.1, max_depth=6, min_samples_leaf=20,
+            max_bins=255, l2=1.0, k=38):
+        self.n_estimators = n_estimators
+        self.learning_rate = learning_rate
+        self.max_depth = max_depth
+        self.min_samples_leaf = min_samples_leaf
+        self.max_bins = max_bins
+        self.l2 = l2
+        self.k = k
+
+    def fit(self, X, rel, srch_ids, verbose=True):
+        """
+        Fit the ranker.
+
+        Args:
+            X: feature matrix.
+            rel: relevance grades (e.g. evaluate.relevance()).
+            srch_ids: search id of every row.
+            verbose: print the training nDCG every 10 rounds.
+
+        Returns:
+            self.
+        """
+        order = np.argsort(srch_ids, kind="mergesort")
+        X, rel, srch_ids = np.asarray(X, dtype=float)[order], np.asarray(rel)[order], np.asarray(srch_ids)[order]
+        starts, search = evaluate.search_starts(srch_ids)
+        position = np.arange(len(srch_ids)) - starts[search]
+
+        self.bin_mapper_ = BinMapper(self.max_bins, subsample=None)
+        ## column-major, so the histogram of a feature reads one contiguous column
+        codes = np.asfortranarray(self.bin_mapper_.fit_transform(X))
+        self.trees_ = []
+        scores = np.zeros(len(X))
+        for i in range(self.n_estimators):
+            grad, hess = lambda_gradients(scores, rel, starts, search, position, self.k)
+            tree, leaf_of_row = self._grow(codes, grad, hess)
+            self.trees_.append(tree)
+            scores += tree[4][leaf_of_row]
+            if verbose and (i + 1) % 10 == 0:
+                print("round {}: train nDCG@{} {:.4f}".format(i + 1, self.k, evaluate.ndcg(srch_ids, rel, scores, self.k, grouped=True)))
+        return self
+
+    def _grow(self, codes, grad, hess):
+        """
+        Grow one tree level by level on the binned features.
+
+        Returns:
+            ((feature, threshold, left, right, value) arrays, node of every row).
+        """
+        n_rows, n_features = codes.shape
+        ## one histogram slot per code, the missing code included
+        n_bins = self.bin_mapper_.missing_code + 1
+        feature, threshold, left, right = [-1], [0.0], [-1], [-1]
+        node_of_row = np.zeros(n_rows, dtype=np.int64)
+        level = [0]
+        for depth in range(self.max_depth):
+            ## per-node, per-feature, per-bin sums of gradient, hessian and count
+            local = np.full(len(feature), -1)
+            local[level] = np.arange(len(level))
+            row_local = local[node_of_row]
+            active = np.flatnonzero(row_local >= 0)
+            base, g, h = row_local[active] * n_bins, grad[active], hess[active]
+            size = len(level) * n_bins
+            shape = (len(level), n_features, n_bins)
+            G, H, C = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+            for j in range(n_features):
+                index = base + codes[active,j]
+                G[:,j] = np.bincount(index, g, size).reshape(len(level), n_bins)
+                H[:,j] = np.bincount(index, h, size).reshape(len(level), n_bins)
+                C[:,j] = np.bincount(index, None, size).reshape(len(level), n_bins)
+            GL, HL, CL = G.cumsum(axis=2), H.cumsum(axis=2), C.cumsum(axis=2)
+            Gt, Ht, Ct = GL[:,:,-1:], HL[:,:,-1:], CL[:,:,-1:]
+            gain = GL ** 2 / (HL + self.l2) + (Gt - GL) ** 2 / (Ht - HL + self.l2) - Gt ** 2 / (Ht + self.l2)
+            allowed = (CL >= self.min_samples_leaf) & (Ct - CL >= self.min_samples_leaf)
+            gain = np.where(allowed, gain, -np.inf)
+
+            next_level = []
+            for n, node in enumerate(level):
+                j, b = np.unravel_index(np.argmax(gain[n]), gain[n].shape)
+                if not gain[n, j, b] > 0:
+                    continue
+                feature[node], threshold[node] = j, self.bin_mapper_.threshold(j, b)
+                left[node], right[node] = len(feature), len(feature) + 1
+                for _ in range(2):
+                    feature.append(-1)
+                    threshold.append(0.0)
+                    left.append(-1)
+                    right.append(-1)
+                rows = node_of_row == node
+                go_left = codes[rows,j] <= b
+                node_of_row[np.flatnonzero(rows)[go_left]] = left[node]
+                node_of_row[np.flatnonzero(rows)[~go_left]] = right[node]
+                next_level += [left[node], right[node]]
+            if not next_level:
+                break
+            level = next_level
+
+        ## Newton step on every leaf
+        G = np.bincount(node_of_row, grad, len(feature))
+        H = np.bincount(node_of_row, hess, len(feature))
+        value = -self.learning_rate * G / (H + self.l2)
+        tree = (np.asarray(feature), np.asarray(threshold), np.asarray(left), np.asarray(right), value)
+        return tree, node_of_row
+
+    def predict(self, X):
+        """
+        Ranking scores, higher ranks first.
+        """
+        X = np.asarray(X, dtype=float)
+        rows = np.arange(len(X))
+        scores = np.zeros(len(X))
+        for feature, threshold, left, right, value in self.trees_:
+            node = np.zeros(len(X), dtype=np.int64)
+            for _ in range(self.max_depth):
+                split = feature[node] >= 0
+                go_left = X[rows, np.maximum(feature[node], 0)] <= threshold[node]
+                node = np.where(split, np.where(go_left, left[node], right[node]), node)
+            scores += value[node]
+        return scores
@@ -1,50 +1,65 @@
 import data_import
-import train
-from datetime import datetime
-
-def main():
-    ## load test data set and do feature engineering
-    test = data_import.load_test()
-    train.feature_eng(test)
-
-    ## load classifier for the booking_bool
-    print("Loading the Booking classifier..")
-    tstart = datetime.now()
-    classifier = data_import.load_model(True)
-    print("Time used:" + str(datetime.now() - tstart) + "\n")
-
-    ## predict the booking_bool
-    print("Making predictions on the booking_bool..")
-    tstart = datetime.now()
-    book_feature_names = train.get_features(test)
-    book_X =  test[book_feature_names].values
-    book_Y_pred = classifier.predict_proba(book_X)[:,1]
-    book_Y_pred = list(-1.0 * book_Y_pred)
-    print("Time used:" + str(datetime.now() - tstart) + "\n")
+import sampling
+import scoring
+import profiling
+import multiprocessing
+from collections import deque
 
+def imap_bounded(pool, func, iterable, window):
+    """
+    Ordered pool.imap() that keeps at most 'window' tasks in flight, so the
+    input is not read ahead of the workers.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
 
-    ## load classifier for the click_bool
-    print("Loading the Click classifier..")
-    tstart = datetime.now()
-    classifier = data_import.load_model(False)
-    print("Time used:" + str(datetime.now() - tstart) + "\n")
+def write_results(results, score_path=None):
+    """
+    Write the scored chunks to the submission as they arrive; chunks hold
+    whole searches, so each one is ordered on its own. The raw scores are
+    kept as well for blend.py if score_path is set.
+    """
+    score_writer = data_import.ScoreWriter(score_path) if score_path else None
+    try:
+        with data_import.SubmissionWriter() as writer:
+            for srch_ids, prop_ids, scores in results:
+                with profiling.stage("write", report=False) as write_span:
+                    writer.write(srch_ids, prop_ids, scores)
+                    if score_writer is not None:
+                        score_writer.write(srch_ids, prop_ids, scores)
+                    write_span.rows = len(srch_ids)
+    finally:
+        if score_writer is not None:
+            score_writer.close()
 
-    ## predict the click_bool
-    print("Making predictions on the click_bool..")
-    tstart = datetime.now()
-    click_feature_names = train.get_features(test)
-    click_X =  test[click_feature_names].values
-    click_Y_pred = classifier.predict_proba(click_X)[:,1]
-    click_Y_pred = list(-1.0 * click_Y_pred)
-    print("Time used:" + str(datetime.now() - tstart) + "\n")
-
-    ## Making results where 3rd column is the score based on likelihood of click and booking
-    results = zip(test["srch_id"], test["prop_id"], 4 * book_Y_pred + click_Y_pred)
-
-    print("Writing predictions to file..")
-    tstart = datetime.now()
-    data_import.write_submission(results)
-    print("Time used:" + str(datetime.now() - tstart) + "\n")
+def main():
+    paths = data_import.get_paths()
+    profiling.configure(paths)
+    n_jobs = paths["n_jobs"] or multiprocessing.cpu_count()
+    with profiling.stage("predict"):
+        ## score chunks of whole searches, in parallel when more than one worker
+        print("Making predictions on the booking_bool and click_bool with {} workers..".format(n_jobs))
+        with profiling.stage("score") as span:
+            ## the test file is streamed, so it is never held in memory whole
+            chunks = sampling.aligned_chunks(data_import.read_chunks(paths["test_path"], paths["chunksize"]))
+            span.rows = 0
+            def counted(chunks):
+                for chunk in chunks:
+                    span.rows += len(chunk)
+                    yield chunk
+            if n_jobs == 1:
+                scoring.init_scorer()
+                write_results((scoring.score_chunk(chunk) for chunk in counted(chunks)), paths["score_path"])
+            else:
+                ## the workers are terminated on the way out, even if writing fails
+                with multiprocessing.Pool(n_jobs, initializer=scoring.init_scorer) as pool:
+                    write_results(imap_bounded(pool, scoring.score_chunk, counted(chunks), 2 * n_jobs), paths["score_path"])
+    profiling.save_trace(paths, "predict")
 
 
 if __name__=="__main__":
@@ -0,0 +1,272 @@
+import os
+import json
+import time
+import cProfile
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    ## not available on Windows
+    resource = None
+
+def peak_rss_mb(who="self"):
+    """
+    High-water mark of the resident set size in MB over the whole life of
+    this process or of its waited-for children ('children'), or None where
+    unsupported.
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN)
+    ## kilobytes on Linux, bytes on macOS
+    scale = 1024.0 * 1024.0 if os.uname()[0] == "Darwin" else 1024.0
+    return usage.ru_maxrss / scale
+
+def rss_mb():
+    """
+    Current resident set size in MB of this process, or None where
+    /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024.0 * 1024.0)
+
+def hwm_mb():
+    """
+    High-water mark of the resident set size in MB of this process since
+    it started or since the last reset_hwm(), or None where /proc is not
+    available.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    return None
+
+def reset_hwm():
+    """
+    Reset the high-water mark read by hwm_mb() to the current RSS (Linux
+    /proc/self/clear_refs). Returns False where that is not supported.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except (IOError, OSError):
+        return False
+    return True
+
+def cpu_seconds():
+    """
+    User + system time of this process and its waited-for children.
+    """
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+class Span(object):
+    """
+    One timed stage. Set 'rows' inside the stage to get its throughput.
+
+    rss_start_mb and rss_end_mb are the resident set size when the stage
+    opens and closes and peak_rss_mb its highest value while the stage ran
+    (None where the high-water mark cannot be reset, see reset_hwm()), so
+    a temporary freed before the end of the stage still shows;
+    process_peak_rss_mb and children_peak_rss_mb are the lifetime
+    high-water marks of the process and its waited-for children when it
+    closes, so they never go down from one stage to the next.
+    """
+    def __init__(self, name, path, depth):
+        self.name, self.path, self.depth = name, path, depth
+        self.rows = None
+        self.start = self.wall = self.cpu = None
+        self.rss_start_mb = self.rss_end_mb = self.peak_rss_mb = None
+        self.process_peak_rss_mb = self.children_peak_rss_mb = None
+
+    @property
+    def rss_delta_mb(self):
+        if self.rss_start_mb is None or self.rss_end_mb is None:
+            return None
+        return self.rss_end_mb - self.rss_start_mb
+
+    def to_dict(self):
+        span = OrderedDict([("name", self.name), ("path", self.path), ("depth", self.depth),
+            ("start", self.start), ("wall", self.wall), ("cpu", self.cpu),
+            ("rss_start_mb", self.rss_start_mb), ("rss_end_mb", self.rss_end_mb), ("rss_delta_mb", self.rss_delta_mb),
+            ("peak_rss_mb", self.peak_rss_mb),
+            ("process_peak_rss_mb", self.process_peak_rss_mb), ("children_peak_rss_mb", self.children_peak_rss_mb),
+            ("rows", self.rows)])
+        span["rows_per_sec"] = self.rows / self.wall if self.rows is not None and self.wall else None
+        return span
+
+class Profiler(object):
+    """
+    Nested named stages with wall time, CPU time, RSS and rows/sec.
+
+    Stages nest with the 'with' statement; every closed stage is recorded
+    as a span whose path joins the names of its enclosing stages with '/'.
+    save() writes the spans and a per-path summary as a JSON trace. With
+    profile_dir set, every stage path also gets its own cProfile profile,
+    saved to '<path>.prof' by save(): only the innermost running stage is
+    profiled, so a dump holds the work of its stage outside the nested
+    stages, and repeated stages add up in the same dump.
+
+    Args:
+        profile_dir: directory of the cProfile dumps (None to disable).
+        verbose: print 'Time used:' lines when stages close.
+    """
+    def __init__(self, profile_dir=None, verbose=True):
+        self.profile_dir = profile_dir
+        self.verbose = verbose
+        self.spans = []
+        self.stack = []
+        self.origin = time.time()
+        self._profiles = OrderedDict()
+        ## the resets of the high-water mark also lower the process's own, so its lifetime peak is kept here
+        self._process_peak_mb = None
+
+    def _fold_peak(self, span):
+        """
+        Fold the high-water mark since the last reset into the peak of a span.
+        """
+        hwm = hwm_mb()
+        if hwm is not None:
+            span.peak_rss_mb = max(span.peak_rss_mb, hwm) if span.peak_rss_mb is not None else hwm
+            self._process_peak_mb = max(self._process_peak_mb or 0.0, hwm)
+
+    @contextmanager
+    def stage(self, name, report=True):
+        path = "/".join([s.name for s in self.stack] + [name])
+        span = Span(name, path, len(self.stack))
+        span.start = time.time() - self.origin
+        span.rss_start_mb = rss_mb()
+        ## the peak of the parent so far is kept before the mark is reset for this stage
+        if self.stack:
+            self._fold_peak(self.stack[-1])
+        if reset_hwm():
+            span.peak_rss_mb = hwm_mb()
+        parent = self.stack[-1].path if self.stack else None
+        profile = None
+        if self.profile_dir:
+            ## one profiler can be enabled at a time: the parent stage pauses
+            if parent in self._profiles:
+                self._profiles[parent].disable()
+            profile = self._profiles.setdefault(path, cProfile.Profile())
+            profile.enable()
+        self.stack.append(span)
+        wall, cpu = time.time(), cpu_seconds()
+        try:
+            yield span
+        finally:
+            span.wall = time.time() - wall
+            span.cpu = cpu_seconds() - cpu
+            if profile is not None:
+                profile.disable()
+                if parent in self._profiles:
+                    self._profiles[parent].enable()
+            span.rss_end_mb = rss_mb()
+            if span.peak_rss_mb is not None:
+                self._fold_peak(span)
+            process_peak = peak_rss_mb()
+            span.process_peak_rss_mb = max(process_peak, self._process_peak_mb or 0.0) if process_peak is not None else None
+            span.children_peak_rss_mb = peak_rss_mb("children")
+            self.stack.pop()
+            ## the enclosing stage peaked at least as high
+            if self.stack and self.stack[-1].peak_rss_mb is not None and span.peak_rss_mb is not None:
+                self.stack[-1].peak_rss_mb = max(self.stack[-1].peak_rss_mb, span.peak_rss_mb)
+            self.spans.append(span)
+            if self.verbose and report:
+                self.report(span)
+
+    def dump_profiles(self):
+        """
+        Write the cProfile dump of every stage path to profile_dir.
+        """
+        if not self._profiles:
+            return
+        if not os.path.exists(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        for path, profile in self._profiles.items():
+            file_name = path.replace("/", "__").replace(" ", "_")
+            profile.dump_stats(os.path.join(self.profile_dir, file_name + ".prof"))
+
+    def report(self, span):
+        line = "Time used:" + str(timedelta(seconds=span.wall)) + " [{}] (cpu {:.1f}s".format(span.path, span.cpu)
+        if span.rss_end_mb is not None:
+            line += ", RSS {:.0f} -> {:.0f} MB".format(span.rss_start_mb, span.rss_end_mb)
+            if span.peak_rss_mb is not None:
+                line += ", peak {:.0f} MB".format(span.peak_rss_mb)
+        if span.rows is not None and span.wall:
+            line += ", {:.0f} rows/s".format(span.rows / span.wall)
+        print(line + ")\n")
+
+    def summary(self):
+        """
+        Spans aggregated by path: count, total wall/cpu time, rows, the
+        highest RSS at the end of a span, the largest RSS growth within one
+        and the highest peak RSS of one.
+        """
+        stages = OrderedDict()
+        for span in sorted(self.spans, key=lambda s: s.start):
+            stage = stages.setdefault(span.path, OrderedDict([("count", 0), ("wall", 0.0), ("cpu", 0.0),
+                ("rows", None), ("rss_end_mb", span.rss_end_mb), ("rss_delta_mb", span.rss_delta_mb),
+                ("peak_rss_mb", span.peak_rss_mb)]))
+            stage["count"] += 1
+            stage["wall"] += span.wall
+            stage["cpu"] += span.cpu
+            if span.rows is not None:
+                stage["rows"] = (stage["rows"] or 0) + span.rows
+            if span.rss_end_mb is not None:
+                stage["rss_end_mb"] = max(stage["rss_end_mb"], span.rss_end_mb)
+                stage["rss_delta_mb"] = max(stage["rss_delta_mb"], span.rss_delta_mb)
+            if span.peak_rss_mb is not None:
+                stage["peak_rss_mb"] = max(stage["peak_rss_mb"], span.peak_rss_mb)
+        for stage in stages.values():
+            stage["rows_per_sec"] = stage["rows"] / stage["wall"] if stage["rows"] is not None and stage["wall"] else None
+        return stages
+
+    def save(self, path, name=None):
+        """
+        Write the JSON trace of all closed spans.
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        trace = OrderedDict([("name", name), ("created", datetime.now().isoformat()),
+            ("spans", [s.to_dict() for s in sorted(self.spans, key=lambda s: s.start)]),
+            ("stages", self.summary())])
+        with open(path, "w") as f:
+            json.dump(trace, f, indent=2)
+        if self.profile_dir:
+            self.dump_profiles()
+
+## process-wide profiler used by the pipeline scripts
+profiler = Profiler()
+
+def stage(name, report=True):
+    """
+    Time a stage of the process-wide profiler (see Profiler.stage());
+    report=False keeps repeated small stages out of the output.
+    """
+    return profiler.stage(name, report)
+
+def configure(paths):
+    """
+    Set up the process-wide profiler from SETTINGS.json ('trace_dir',
+    'profile_stages').
+    """
+    if paths.get("profile_stages") and paths.get("trace_dir"):
+        profiler.profile_dir = os.path.join(paths["trace_dir"], "profiles")
+
+def save_trace(paths, name):
+    """
+    Write the trace of the process-wide profiler to '<trace_dir>/<name>.json'.
+    """
+    if paths.get("trace_dir"):
+        profiler.save(os.path.join(paths["trace_dir"], name + ".json"), name)
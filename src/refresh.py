@@ -0,0 +1,117 @@
+import data_import
+import cache
+import compiled_model
+import profiling
+import tuning
+import os
+import sys
+import numpy as np
+from datetime import datetime
+from sklearn.ensemble import GradientBoostingClassifier
+from stats_index import load_indexes, save_indexes
+
+def refresh_model(model, X, y, n_trees, n_stages, rng):
+    """
+    Extend a fitted soft VotingClassifier with a batch of new rows.
+
+    The forests get n_trees new trees grown on the batch (warm start) and
+    the gradient boosting component gets n_stages more stages boosted
+    from its current predictions on the batch. Old trees are kept as they
+    are, so the cost only depends on the size of the batch.
+
+    Args:
+        model: fitted VotingClassifier (or a single forest/boosting model).
+        X: feature matrix of the batch.
+        y: array of 0/1 outcomes.
+        n_trees: new trees per forest.
+        n_stages: new boosting stages.
+        rng: random state of the negative downsampling.
+
+    Returns:
+        the number of rows fitted.
+    """
+    ## same downsampling as the full fit
+    rows = tuning.balanced_indices(y, np.arange(len(y)), rng)
+    for est in getattr(model, "estimators_", [model]):
+        if isinstance(est, GradientBoostingClassifier):
+            est.set_params(warm_start=True, n_estimators=est.n_estimators_ + n_stages)
+        else:
+            est.set_params(warm_start=True, n_estimators=len(est.estimators_) + n_trees)
+        est.fit(X[rows], y[rows])
+    return len(rows)
+
+def main():
+    """
+    Refresh the saved models, cascade pre-scorer and transformer with the
+    log files given as arguments (train.csv schema) and save them as a new
+    version.
+    """
+    paths = data_import.get_paths()
+    profiling.configure(paths)
+    if paths["model_type"] == "lambdarank":
+        print("Refresh is only supported for the ensemble models")
+        sys.exit(1)
+    logs = sys.argv[1:]
+    if not logs:
+        print("Usage: python refresh.py log.csv [log.csv ...]")
+        sys.exit(1)
+
+    transformer = data_import.load_transformer()
+    models = {"booking_bool": data_import.load_model(True), "click_bool": data_import.load_model(False)}
+    prescorer = data_import.load_prescorer() if os.path.exists(paths["prescorer_path"]) else None
+    refreshed = getattr(transformer, "refreshed_sources_", [])
+    rng = np.random.RandomState(42)
+    version = datetime.now().strftime("%Y%m%d%H%M%S")
+    with profiling.stage("refresh"):
+        new_sources = []
+        for log in logs:
+            source = "{}:{}:{}".format(os.path.abspath(log), *cache.source_key(log))
+            if source in refreshed:
+                print("Skipping {}, already refreshed".format(log))
+                continue
+            print("Refreshing with {}...".format(log))
+            with profiling.stage("read " + os.path.basename(log)) as span:
+                batch = data_import.read_compact(log)
+                span.rows = len(batch)
+            ## the batch is merged into the history first, then engineered leave-one-out like the training set
+            with profiling.stage("update features") as span:
+                transformer.update(batch)
+                transformer.transform(batch)
+                X = transformer.matrix(batch)
+                span.rows = len(batch)
+            for outcome, model in sorted(models.items()):
+                y = batch[outcome].values
+                ## the downsampling keeps as many negatives as positives, a fit needs both
+                if len(np.unique(y)) < 2:
+                    print("Skipping {} of {}, the batch holds one class only".format(outcome, log))
+                    continue
+                with profiling.stage("refresh " + outcome) as span:
+                    span.rows = refresh_model(model, X, y, paths["refresh_trees"], paths["refresh_stages"], rng)
+                if outcome == "click_bool" and prescorer is not None:
+                    with profiling.stage("refresh prescorer") as span:
+                        rows = tuning.balanced_indices(y, np.arange(len(y)), rng)
+                        prescorer.update(X[rows], y[rows])
+                        span.rows = len(rows)
+            new_sources.append(source)
+        if not new_sources:
+            return
+        transformer.refreshed_sources_ = refreshed + new_sources
+
+        print("Saving model version {}...".format(version))
+        with profiling.stage("save"):
+            data_import.save_model(models["booking_bool"], True, version)
+            data_import.save_model(models["click_bool"], False, version)
+            data_import.save_transformer(transformer, version)
+            if prescorer is not None:
+                data_import.save_prescorer(prescorer, version)
+            ## keep the stats index file in step with the transformer's copy
+            if getattr(transformer, "stats_", None) is not None and os.path.exists(paths["stats_index_path"]):
+                sources = load_indexes(paths["stats_index_path"])[1]
+                save_indexes(transformer.stats_, paths["stats_index_path"], sources + new_sources)
+            ## serve.py scores with the artifact whenever it exists
+            if os.path.exists(paths["compiled_model_path"]):
+                compiled_model.build(paths, models["booking_bool"], models["click_bool"], transformer)
+    profiling.save_trace(paths, "refresh")
+
+if __name__=="__main__":
+    main()
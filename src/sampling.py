@@ -0,0 +1,153 @@
+import numpy as np
+import pandas as pd
+
+## search strata: at least one booking, at least one click but no booking, neither
+STRATA = ["booking", "click", "none"]
+
+## default share of the row budget of each stratum
+STRATUM_RATIOS = {"booking": 0.5, "click": 0.3, "none": 0.2}
+
+def search_priority(srch_ids, random_state=42):
+    """
+    Random priority in [0, 1) of every search, a hash of its srch_id.
+
+    The priority only depends on the id and the seed, so the rows of a
+    search get the same priority in whichever chunk they arrive.
+    """
+    with np.errstate(over="ignore"):
+        x = np.asarray(srch_ids).astype(np.uint64) + np.uint64(random_state) * np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        x = x ^ (x >> np.uint64(31))
+    return (x >> np.uint64(11)).astype(float) / 2.0 ** 53
+
+def aligned_chunks(chunks):
+    """
+    Re-cut a stream of chunks so that no search spans two chunks.
+
+    The rows of the last search of every chunk are held back and prepended
+    to the next chunk.
+
+    Args:
+        chunks: iterable of data objects, rows of a search contiguous.
+
+    Returns:
+        generator of data objects.
+    """
+    tail = None
+    for chunk in chunks:
+        if tail is not None:
+            chunk = pd.concat([tail, chunk], ignore_index=True)
+        ids = chunk["srch_id"].values
+        if not len(ids):
+            continue
+        others = np.flatnonzero(ids != ids[-1])
+        cut = others[-1] + 1 if len(others) else 0
+        if cut:
+            yield chunk.iloc[:cut]
+        tail = chunk.iloc[cut:]
+    if tail is not None and len(tail):
+        yield tail
+
+def search_strata(df):
+    """
+    Stratum (index into STRATA) of every row, from the outcomes of its search.
+
+    Args:
+        df: data object holding complete searches, rows of a search contiguous.
+
+    Returns:
+        array of stratum indices.
+    """
+    ids = df["srch_id"].values
+    new_search = np.r_[True, ids[1:] != ids[:-1]]
+    starts, search = np.flatnonzero(new_search), np.cumsum(new_search) - 1
+    booked = np.maximum.reduceat(df["booking_bool"].values, starts)[search]
+    clicked = np.maximum.reduceat(df["click_bool"].values, starts)[search]
+    return np.where(booked == 1, 0, np.where(clicked == 1, 1, 2))
+
+class SearchReservoir(object):
+    """
+    Bottom-k sample of whole searches under a row budget.
+
+    Searches are kept in order of their priority until the budget is
+    full. Once it is, every later row whose priority is above the current
+    cut-off is dropped on arrival, so at most 2 * max_rows rows plus one
+    chunk are ever held in memory.
+
+    Args:
+        max_rows: the number of rows kept.
+    """
+    def __init__(self, max_rows):
+        self.max_rows = max_rows
+        self.threshold = np.inf
+        self.parts, self.priorities = [], []
+        self.n_rows = 0
+
+    def add(self, chunk, priority):
+        """
+        Offer the rows of a chunk with the priority of their search.
+        """
+        keep = priority < self.threshold
+        if not keep.any():
+            return
+        self.parts.append(chunk[keep])
+        self.priorities.append(priority[keep])
+        self.n_rows += keep.sum()
+        if self.n_rows > 2 * self.max_rows:
+            self._trim()
+
+    def _trim(self):
+        priority = np.concatenate(self.priorities)
+        values, counts = np.unique(priority, return_counts=True)
+        n_searches = np.searchsorted(np.cumsum(counts), self.max_rows, side="right")
+        if n_searches < len(values):
+            self.threshold = values[n_searches]
+        keep = priority < self.threshold
+        self.parts = [pd.concat(self.parts, ignore_index=True)[keep]]
+        self.priorities = [priority[keep]]
+        self.n_rows = keep.sum()
+
+    def frame(self):
+        """
+        The sampled rows.
+        """
+        if not self.parts:
+            return None
+        self._trim()
+        return self.parts[0]
+
+def sample_searches(chunks, max_rows=1000000, ratios=None, random_state=42):
+    """
+    Stratified sample of whole searches in a single pass over chunked input.
+
+    Every search falls into one of STRATA, and each stratum keeps a
+    bottom-k reservoir of searches under its share of the row budget. The
+    sample stays grouped by search. Downsampling negatives row by row for
+    the booking and click classifiers is then done on the sample (see
+    tuning.balanced_indices()).
+
+    Args:
+        chunks: iterable of data objects (e.g. data_import.iter_train()).
+        max_rows: the number of sampled rows.
+        ratios: dict of share of max_rows per stratum (STRATUM_RATIOS if None).
+        random_state: seed of the search priorities.
+
+    Returns:
+        data object sorted by srch_id.
+    """
+    ratios = ratios or STRATUM_RATIOS
+    reservoirs = [SearchReservoir(int(max_rows * ratios.get(name, 0))) for name in STRATA]
+    n_rows = 0
+    for chunk in aligned_chunks(chunks):
+        n_rows += len(chunk)
+        priority = search_priority(chunk["srch_id"].values, random_state)
+        strata = search_strata(chunk)
+        for s, reservoir in enumerate(reservoirs):
+            if reservoir.max_rows > 0:
+                reservoir.add(chunk[strata == s], priority[strata == s])
+    frames = [reservoir.frame() for reservoir in reservoirs]
+    sample = pd.concat([f for f in frames if f is not None], ignore_index=True)
+    sample = sample.iloc[np.argsort(sample["srch_id"].values, kind="mergesort")].reset_index(drop=True)
+    print("Sampled {} of {} rows ({} searches)".format(len(sample), n_rows, sample["srch_id"].nunique()))
+    return sample
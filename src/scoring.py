@@ -0,0 +1,58 @@
+import data_import
+import serve
+
+## per-process state of the scoring workers
+_scorer = {}
+
+def init_scorer():
+    """
+    Load the feature transformer and the classifiers once per process.
+
+    Batches are scored with the sklearn classifiers: the compiled artifact
+    (compiled_model.py) is only faster on single searches, so only
+    serve.py uses it.
+    """
+    paths = data_import.get_paths()
+    _scorer["transformer"] = data_import.load_transformer()
+    if paths["model_type"] == "lambdarank":
+        _scorer["rank"] = data_import.load_ranker()
+    else:
+        _scorer["book"] = serve.single_threaded(data_import.load_model(True))
+        _scorer["click"] = serve.single_threaded(data_import.load_model(False))
+    if paths["cascade_k"] and paths["model_type"] != "lambdarank":
+        _scorer["prescorer"] = data_import.load_prescorer()
+        _scorer["cascade_k"] = paths["cascade_k"]
+
+def ensemble_scores(X):
+    """
+    4 * P(book) + P(click) of every row with the loaded classifiers.
+    """
+    book = _scorer["book"].predict_proba(X)[:,1]
+    click = _scorer["click"].predict_proba(X)[:,1]
+    return 4 * book + click
+
+def score_chunk(test):
+    """
+    Feature-engineer a chunk of whole searches and score it with both
+    classifiers (or the LambdaRank model). With 'cascade_k' set, the
+    classifiers only score the top cascade_k rows of every search by the
+    pre-scorer (see cascade.py).
+
+    Args:
+        test: data object holding complete searches.
+
+    Returns:
+        (srch_id, prop_id, score) arrays, lower score ranks first.
+    """
+    ## chunks of the cached data are read-only views
+    test = test.copy()
+    transformer = _scorer["transformer"]
+    transformer.transform(test)
+    X = transformer.matrix(test)
+    if "rank" in _scorer:
+        return test["srch_id"].values, test["prop_id"].values, -_scorer["rank"].predict(X)
+    if "prescorer" in _scorer:
+        scores = _scorer["prescorer"].cascade_scores(X, test["srch_id"].values, ensemble_scores, _scorer["cascade_k"])
+    else:
+        scores = ensemble_scores(X)
+    return test["srch_id"].values, test["prop_id"].values, -1.0 * scores
@@ -0,0 +1,184 @@
+import data_import
+import compiled_model
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+from collections import deque
+from features import SearchCache
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+## columns only present in the training set
+LABEL_NAMES = ["position", "click_bool", "gross_bookings_usd", "booking_bool"]
+
+def single_threaded(model):
+    """
+    Make a fitted VotingClassifier score in the calling thread.
+
+    Scoring 25-40 rows is far cheaper than starting a joblib pool, so the
+    sub-estimators' n_jobs is set to 1 (and their verbose output off).
+    """
+    for est in getattr(model, "estimators_", [model]):
+        if hasattr(est, "n_jobs"):
+            est.n_jobs = 1
+        if hasattr(est, "verbose"):
+            est.verbose = 0
+    return model
+
+class Ranker(object):
+    """
+    Rank the candidate hotels of a single search request.
+
+    Both classifiers and the fitted feature transformer are loaded once,
+    so each request only pays for the per-row transforms and scoring.
+
+    Args:
+        book_model: booking classifier (loaded from SETTINGS.json if None).
+        click_model: click classifier (loaded from SETTINGS.json if None).
+        transformer: fitted FeatureTransformer (loaded if None).
+        compiled: CompiledEnsemble of 'book' and 'click' used instead of
+            the classifiers, if given.
+        rank_model: LambdaRankModel used instead of the classifiers, if given.
+        history: the number of request latencies kept for stats().
+        search_cache: the number of search-level feature entries cached
+            across requests (0 to disable, see features.SearchCache).
+    """
+    def __init__(self, book_model=None, click_model=None, transformer=None, compiled=None,
+            rank_model=None, history=10000, search_cache=10000):
+        self.compiled = compiled
+        self.rank_model = rank_model
+        if compiled is None and rank_model is None:
+            self.book_model = single_threaded(data_import.load_model(True) if book_model is None else book_model)
+            self.click_model = single_threaded(data_import.load_model(False) if click_model is None else click_model)
+        self.transformer = data_import.load_transformer() if transformer is None else transformer
+        self.latencies = deque(maxlen=history)
+        self.search_cache = SearchCache(search_cache) if search_cache else None
+
+    def columns(self, rows):
+        """
+        Build the raw column arrays of a request.
+
+        Args:
+            rows: list of dicts (one per candidate hotel, test.csv columns;
+                missing values may be omitted) or a data object.
+
+        Returns:
+            dict of column name to array, with the compact schema.
+        """
+        if isinstance(rows, pd.DataFrame):
+            rows = rows.to_dict("records")
+        columns = {"date_time": np.array([row["date_time"] for row in rows])}
+        for name, dtype in data_import.DTYPES.items():
+            if name not in LABEL_NAMES:
+                columns[name] = np.array([row.get(name, np.nan) for row in rows], dtype=dtype)
+        return columns
+
+    def score(self, rows):
+        """
+        Score the candidate hotels of one search.
+
+        Returns:
+            (column arrays, scores) where score is 4 * P(book) + P(click),
+            or the LambdaRank score.
+        """
+        columns = self.columns(rows)
+        X = self.transformer.request_matrix(columns, self.search_cache)
+        if self.rank_model is not None:
+            return columns, self.rank_model.predict(X)
+        if self.compiled is not None:
+            proba = self.compiled.predict_proba(X)
+            book = proba[:,self.compiled.names.index("book")]
+            click = proba[:,self.compiled.names.index("click")]
+        else:
+            book = self.book_model.predict_proba(X)[:,1]
+            click = self.click_model.predict_proba(X)[:,1]
+        return columns, 4 * book + click
+
+    def rank(self, rows):
+        """
+        Order the candidate hotels of one search, best first.
+
+        Returns:
+            list of prop_id.
+        """
+        tstart = time.time()
+        columns, scores = self.score(rows)
+        order = np.argsort(-scores, kind="mergesort")
+        ranking = columns["prop_id"][order].tolist()
+        self.latencies.append(time.time() - tstart)
+        return ranking
+
+    def stats(self):
+        """
+        Latency percentiles of the recent requests in milliseconds.
+        """
+        if not self.latencies:
+            return {"requests": 0}
+        ms = 1000 * np.array(self.latencies)
+        return {"requests": len(ms),
+            "p50_ms": float(np.percentile(ms, 50)),
+            "p99_ms": float(np.percentile(ms, 99))}
+
+def make_handler(ranker):
+    """
+    Build the HTTP handler class bound to a ranker.
+
+    POST /rank with {"rows": [...]} returns {"srch_id": ..., "prop_ids": [...]};
+    GET /stats returns the latency percentiles.
+    """
+    class RankHandler(BaseHTTPRequestHandler):
+        def _reply(self, code, body):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._reply(200, ranker.stats())
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/rank":
+                self._reply(404, {"error": "not found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                rows = json.loads(self.rfile.read(length).decode("utf-8"))["rows"]
+                prop_ids = ranker.rank(rows)
+            except (ValueError, KeyError, TypeError) as e:
+                self._reply(400, {"error": str(e)})
+                return
+            self._reply(200, {"srch_id": rows[0].get("srch_id") if rows else None, "prop_ids": prop_ids})
+
+        def log_message(self, format, *args):
+            pass
+
+    return RankHandler
+
+def main():
+    paths = data_import.get_paths()
+    print("Loading the classifiers...")
+    if paths["model_type"] == "lambdarank":
+        ranker = Ranker(rank_model=data_import.load_ranker())
+    elif os.path.exists(paths["compiled_model_path"]):
+        compiled, transformer = compiled_model.load_scorer(paths)
+        ranker = Ranker(compiled=compiled, transformer=transformer)
+    else:
+        ranker = Ranker()
+    server = HTTPServer((paths["serve_host"], paths["serve_port"]), make_handler(ranker))
+    print("Serving rankings on {}:{}".format(paths["serve_host"], paths["serve_port"]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,332 @@
+import data_import
+import cache
+import profiling
+import os
+import sys
+import numpy as np
+import pandas as pd
+from sampling import search_priority
+
+## outcomes whose rates are kept per category and for missing values
+OUTCOMES = ["click_bool", "booking_bool"]
+
+## low-cardinality columns whose outcome rates are kept per value
+CATEGORY_COLUMNS = ["site_id", "prop_starrating", "prop_review_score", "prop_brand_bool", "promotion_flag",
+    "srch_length_of_stay", "srch_adults_count", "srch_children_count", "srch_room_count",
+    "srch_saturday_night_bool", "random_bool", "position"] + \
+    ["comp%d_rate" % i for i in range(1, 9)] + ["comp%d_inv" % i for i in range(1, 9)]
+
+class StreamingStats(object):
+    """
+    Summary statistics of a data set accumulated in one pass over chunks.
+
+    Every chunk is shifted by the column means of the first chunk, masked
+    where values are missing and folded into per-pair sums with a few
+    matrix products: M'M counts the rows where both columns are present,
+    A'M and (A*A)'M sum each column over those rows and A'A sums their
+    products. This gives the null counts, means, variances and the
+    pairwise-complete correlation matrix of DataFrame.corr() for every
+    value of 'condition' (e.g. booking_bool), the whole set being the sum
+    of its groups. Quantiles come from a bottom-k sample of every column
+    keyed on a hash of the row number, so the result does not depend on
+    the chunk size, and the outcome counts of CATEGORY_COLUMNS are kept
+    per value.
+
+    Args:
+        condition: 0/1 column the sums are split by (ignored if absent).
+        sketch_size: the number of values sampled per column for quantiles.
+        random_state: seed of the quantile samples.
+    """
+    def __init__(self, condition="booking_bool", sketch_size=10000, random_state=42):
+        self.condition = condition
+        self.sketch_size = sketch_size
+        self.random_state = random_state
+        self.columns = None
+        self.rows = 0
+
+    def _start(self, chunk):
+        self.columns = [name for name in chunk.columns if chunk[name].dtype.kind in "biuf"]
+        self.groups = [0, 1] if self.condition in chunk.columns else [None]
+        self.outcomes = [name for name in OUTCOMES if name in chunk.columns]
+        n, g = len(self.columns), len(self.groups)
+        X = chunk[self.columns].values.astype(float)
+        with np.errstate(invalid="ignore"):
+            self.shift = np.nan_to_num(np.nanmean(X, axis=0)) if len(X) else np.zeros(n)
+        self.group_rows = np.zeros(g)
+        self.pair_count = np.zeros((g, n, n))
+        self.pair_sum = np.zeros((g, n, n))
+        self.pair_sum_sq = np.zeros((g, n, n))
+        self.pair_product = np.zeros((g, n, n))
+        self.minimum = np.full(n, np.inf)
+        self.maximum = np.full(n, -np.inf)
+        self.outcome_total = dict((name, 0.0) for name in self.outcomes)
+        self.outcome_null = dict((name, np.zeros(n)) for name in self.outcomes)
+        self.sketch = dict((name, (np.zeros(0), np.zeros(0))) for name in self.columns)
+        self.categories = dict((name, dict((s, np.zeros(0)) for s in ["keys", "count"] + self.outcomes))
+            for name in CATEGORY_COLUMNS if name in self.columns)
+
+    def update(self, chunk):
+        """
+        Fold a chunk (data object) into the statistics.
+        """
+        if self.columns is None:
+            self._start(chunk)
+        X = chunk[self.columns].values.astype(float)
+        valid = ~np.isnan(X)
+        A = np.where(valid, X - self.shift, 0.0)
+        M = valid.astype(float)
+        group = chunk[self.condition].values if self.groups[0] is not None else np.zeros(len(chunk), dtype=int)
+        for g in range(len(self.groups)):
+            rows = group == g if len(self.groups) > 1 else slice(None)
+            Ag, Mg = A[rows], M[rows]
+            self.group_rows[g] += len(Ag)
+            self.pair_count[g] += np.dot(Mg.T, Mg)
+            self.pair_sum[g] += np.dot(Ag.T, Mg)
+            self.pair_sum_sq[g] += np.dot((Ag * Ag).T, Mg)
+            self.pair_product[g] += np.dot(Ag.T, Ag)
+        with np.errstate(invalid="ignore"):
+            self.minimum = np.fmin(self.minimum, np.nanmin(np.where(valid, X, np.inf), axis=0))
+            self.maximum = np.fmax(self.maximum, np.nanmax(np.where(valid, X, -np.inf), axis=0))
+        for name in self.outcomes:
+            y = chunk[name].values.astype(float)
+            self.outcome_total[name] += y.sum()
+            self.outcome_null[name] += np.dot(1 - M.T, y)
+
+        ## bottom-k sample of every column by the hashed row number
+        priority = search_priority(np.arange(self.rows, self.rows + len(chunk)), self.random_state)
+        for c, name in enumerate(self.columns):
+            values, priorities = self.sketch[name]
+            keep = valid[:,c]
+            if len(priorities) >= self.sketch_size:
+                keep &= priority < priorities.max()
+            values, priorities = np.r_[values, X[keep,c]], np.r_[priorities, priority[keep]]
+            if len(priorities) > self.sketch_size:
+                top = np.argpartition(priorities, self.sketch_size - 1)[:self.sketch_size]
+                values, priorities = values[top], priorities[top]
+            self.sketch[name] = (values, priorities)
+
+        for name, counts in self.categories.items():
+            c = self.columns.index(name)
+            keys, inverse = np.unique(X[valid[:,c],c], return_inverse=True)
+            merged = np.union1d(counts["keys"], keys)
+            old_pos, new_pos = np.searchsorted(merged, counts["keys"]), np.searchsorted(merged, keys)
+            weights = dict((s, chunk[s].values[valid[:,c]].astype(float)) for s in self.outcomes)
+            weights["count"] = None
+            for s, w in weights.items():
+                total = np.zeros(len(merged))
+                total[old_pos] = counts[s]
+                total[new_pos] += np.bincount(inverse, w, len(keys))
+                counts[s] = total
+            counts["keys"] = merged
+        self.rows += len(chunk)
+        return self
+
+    def _sums(self, given=None):
+        g = slice(None) if given is None else self.groups.index(given)
+        return [s[g].sum(axis=0) if given is None else s[g] for s in
+            [self.pair_count, self.pair_sum, self.pair_sum_sq, self.pair_product]]
+
+    def count(self, given=None):
+        """
+        Non-missing values per column.
+        """
+        return pd.Series(np.diag(self._sums(given)[0]), index=self.columns)
+
+    def null_count(self, given=None):
+        """
+        Missing values per column.
+        """
+        rows = self.rows if given is None else self.group_rows[self.groups.index(given)]
+        return rows - self.count(given)
+
+    def mean(self, given=None):
+        n, s, _, _ = self._sums(given)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return pd.Series(self.shift + np.diag(s) / np.diag(n), index=self.columns)
+
+    def var(self, given=None):
+        """
+        Sample variance (ddof 1) per column.
+        """
+        n, s, ss, _ = [np.diag(x) for x in self._sums(given)]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return pd.Series(np.maximum(ss - s * s / n, 0) / (n - 1), index=self.columns)
+
+    def std(self, given=None):
+        return np.sqrt(self.var(given))
+
+    def corr(self, given=None):
+        """
+        Pairwise-complete Pearson correlation matrix, as DataFrame.corr().
+
+        Args:
+            given: value of the condition column the rows are restricted
+                to (None for all rows).
+
+        Returns:
+            data object indexed by column on both axes.
+        """
+        n, s, ss, p = self._sums(given)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            cov = p - s * s.T / n
+            var_x = ss - s * s / n
+            var_y = var_x.T
+            corr = cov / np.sqrt(var_x * var_y)
+            ## constant columns leave only rounding errors in the variance
+            constant = var_x <= 1e-9 * ss
+            corr[(n < 2) | constant | constant.T] = np.nan
+        return pd.DataFrame(np.clip(corr, -1, 1), index=self.columns, columns=self.columns)
+
+    def quantile(self, name, q):
+        """
+        Approximate quantile(s) of a column from its sample.
+        """
+        values = self.sketch[name][0]
+        return np.percentile(values, np.asarray(q) * 100) if len(values) else np.full(np.shape(q), np.nan)
+
+    def null_rates(self, name):
+        """
+        Outcome rates of the rows where a column is missing vs present.
+
+        Returns:
+            data object indexed by 'null'/'present', one column per outcome.
+        """
+        c = self.columns.index(name)
+        nulls = self.null_count()[name]
+        present = self.rows - nulls
+        rates = {}
+        for outcome in self.outcomes:
+            null_sum = self.outcome_null[outcome][c]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                rates[outcome] = [null_sum / nulls, (self.outcome_total[outcome] - null_sum) / present]
+        return pd.DataFrame(rates, index=["null", "present"]).assign(count=[nulls, present])
+
+    def category_rates(self, name):
+        """
+        Row count and outcome rates per value of one of CATEGORY_COLUMNS.
+        """
+        counts = self.categories[name]
+        df = pd.DataFrame({"count": counts["count"]}, index=pd.Index(counts["keys"], name=name))
+        for outcome in self.outcomes:
+            df[outcome] = counts[outcome] / counts["count"]
+        return df
+
+    def best_support(self, feature_name, candidates=None):
+        """
+        The column with the largest absolute correlation to a feature, by
+        the same rule as features.best_support() (first of equals wins).
+
+        Args:
+            feature_name: feature name.
+            candidates: columns to choose from, in order (all if None).
+        """
+        corr = self.corr()[feature_name].abs()
+        candidates = [name for name in (candidates or self.columns) if name in corr.index]
+        values = corr[candidates].fillna(-1.0).values
+        return candidates[int(np.argmax(values))] if len(values) and values.max() >= 0 else feature_name
+
+    ## attributes saved as arrays by save()
+    ARRAYS = ["shift", "group_rows", "pair_count", "pair_sum", "pair_sum_sq", "pair_product", "minimum", "maximum"]
+
+    def save(self, path):
+        """
+        Save the statistics to a .npz file.
+        """
+        arrays = dict((name, getattr(self, name)) for name in self.ARRAYS)
+        arrays["columns"] = np.asarray(self.columns, dtype=str)
+        arrays["groups"] = np.asarray([-1 if g is None else g for g in self.groups])
+        arrays["outcomes"] = np.asarray(self.outcomes, dtype=str)
+        arrays["params"] = np.asarray([self.rows, self.sketch_size, self.random_state])
+        arrays["condition"] = np.asarray(self.condition)
+        for name in self.outcomes:
+            arrays["outcome_total__" + name] = np.asarray(self.outcome_total[name])
+            arrays["outcome_null__" + name] = self.outcome_null[name]
+        for name, (values, priorities) in self.sketch.items():
+            arrays["sketch__" + name] = values
+            arrays["sketch_priority__" + name] = priorities
+        for name, counts in self.categories.items():
+            for s, values in counts.items():
+                arrays["category__{}__{}".format(name, s)] = values
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load statistics saved by save().
+        """
+        data = np.load(path)
+        rows, sketch_size, random_state = [int(x) for x in data["params"]]
+        stats = cls(str(data["condition"]), sketch_size, random_state)
+        for name in cls.ARRAYS:
+            setattr(stats, name, data[name])
+        stats.rows = rows
+        stats.columns = [str(name) for name in data["columns"]]
+        stats.groups = [None if g == -1 else int(g) for g in data["groups"]]
+        stats.outcomes = [str(name) for name in data["outcomes"]]
+        stats.outcome_total = dict((name, float(data["outcome_total__" + name])) for name in stats.outcomes)
+        stats.outcome_null = dict((name, data["outcome_null__" + name]) for name in stats.outcomes)
+        stats.sketch = dict((name, (data["sketch__" + name], data["sketch_priority__" + name])) for name in stats.columns)
+        stats.categories = dict((name, dict((s, data["category__{}__{}".format(name, s)])
+            for s in ["keys", "count"] + stats.outcomes)) for name in CATEGORY_COLUMNS if name in stats.columns)
+        return stats
+
+def collect(chunks, **params):
+    """
+    Accumulate StreamingStats over an iterable of data objects.
+    """
+    stats = StreamingStats(**params)
+    for chunk in chunks:
+        stats.update(chunk)
+    return stats
+
+def summarize(kind="train", nrows=None):
+    """
+    Statistics of the train/test data set, computed in one chunked scan
+    and cached under 'cache_path' until the file or this module changes.
+
+    Args:
+        kind: 'train' or 'test'.
+        nrows: the number of rows to read in (None for the full file).
+
+    Returns:
+        StreamingStats.
+    """
+    paths = data_import.get_paths()
+    path = paths[kind + "_path"]
+    directory = os.path.join(paths["cache_path"], "stats")
+    name = os.path.splitext(os.path.basename(path))[0]
+    stats_path = os.path.join(directory, "{}-{}.npz".format(name, cache.cache_key(path, (data_import, sys.modules[__name__]), (nrows,))))
+    if os.path.exists(stats_path):
+        return StreamingStats.load(stats_path)
+
+    print("Summarizing {} data...".format(kind))
+    with profiling.stage("summarize " + kind) as span:
+        stats = collect(data_import.read_chunks(path, nrows=nrows))
+        span.rows = stats.rows
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    ## drop stale summaries of the same file
+    for entry in os.listdir(directory):
+        if entry.startswith(name + "-"):
+            os.remove(os.path.join(directory, entry))
+    stats.save(stats_path)
+    return stats
+
+def main():
+    """
+    Summarize the data sets given as arguments ('train', 'test') and print
+    their completeness and moments.
+    """
+    paths = data_import.get_paths()
+    profiling.configure(paths)
+    for kind in sys.argv[1:] or ["train"]:
+        stats = summarize(kind)
+        print("{}: {} rows".format(kind, stats.rows))
+        report = pd.DataFrame({"null_rate": stats.null_count() / stats.rows, "mean": stats.mean(), "std": stats.std(),
+            "min": stats.minimum, "median": [stats.quantile(name, 0.5) for name in stats.columns],
+            "max": stats.maximum}, index=stats.columns)
+        print(report.to_string(float_format="{:.4g}".format))
+    profiling.save_trace(paths, "stats_engine")
+
+if __name__=="__main__":
+    main()
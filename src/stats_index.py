@@ -0,0 +1,194 @@
+import data_import
+import cache
+import profiling
+import os
+import sys
+import numpy as np
+
+## index name -> key column
+INDEX_KEYS = {"prop": "prop_id", "dest": "srch_destination_id"}
+
+class StatsIndex(object):
+    """
+    Historical click/booking/position aggregates per value of a key column.
+
+    The keys are kept sorted with one array of sums per statistic, so a
+    batch of rows is joined with one searchsorted() and new log chunks
+    are merged in without rescanning the history. Positions are only
+    counted in searches that were not randomly ordered (random_bool 0).
+
+    Args:
+        key: key column (e.g. 'prop_id').
+        prefix: prefix of the joined feature names.
+        smoothing: weight of the global rate in the smoothed rates.
+    """
+    SUMS = ["count", "clicks", "bookings", "position_count", "position_sum"]
+
+    def __init__(self, key, prefix, smoothing=10.0):
+        self.key = key
+        self.prefix = prefix
+        self.smoothing = smoothing
+        self.keys = np.zeros(0, dtype=np.int64)
+        for name in self.SUMS:
+            setattr(self, name, np.zeros(0))
+
+    @staticmethod
+    def row_sums(df):
+        """
+        The contribution of every row of a labelled data object to each sum.
+        """
+        ordered = (df["random_bool"].values == 0) & df["position"].notnull().values
+        return {"count": np.ones(len(df)),
+            "clicks": df["click_bool"].values.astype(float),
+            "bookings": df["booking_bool"].values.astype(float),
+            "position_count": ordered.astype(float),
+            "position_sum": np.where(ordered, df["position"].values, 0.0)}
+
+    def update(self, df):
+        """
+        Merge the rows of a labelled data object into the sums.
+        """
+        keys, inverse = np.unique(df[self.key].values.astype(np.int64), return_inverse=True)
+        merged = np.union1d(self.keys, keys)
+        old_pos, new_pos = np.searchsorted(merged, self.keys), np.searchsorted(merged, keys)
+        for name, weights in self.row_sums(df).items():
+            total = np.zeros(len(merged))
+            total[old_pos] = getattr(self, name)
+            total[new_pos] += np.bincount(inverse, weights, len(keys))
+            setattr(self, name, total)
+        self.keys = merged
+        return self
+
+    def lookup(self, keys):
+        """
+        Sums of every statistic for an array of keys (0 for unseen keys).
+        """
+        keys = np.asarray(keys).astype(np.int64)
+        if not len(self.keys):
+            return dict((name, np.zeros(len(keys))) for name in self.SUMS)
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = self.keys[pos] == keys
+        return dict((name, np.where(found, getattr(self, name)[pos], 0.0)) for name in self.SUMS)
+
+    def columns(self, keys, own=None):
+        """
+        The count, smoothed click/booking rates and mean position of an
+        array of keys, as '<prefix>_*' float32 columns.
+
+        Args:
+            keys: array of key values.
+            own: row_sums() of labelled rows that are part of the history,
+                subtracted first (leave-one-out), if any.
+
+        Returns:
+            dict of feature name to array.
+        """
+        sums = self.lookup(keys)
+        if own is not None:
+            for name, weights in own.items():
+                sums[name] = sums[name] - weights
+        n, m = sums["count"], self.smoothing
+        total = max(self.count.sum(), 1.0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            position_mean = np.where(sums["position_count"] > 0, sums["position_sum"] / sums["position_count"],
+                self.position_sum.sum() / max(self.position_count.sum(), 1.0))
+        return {self.prefix + "_count": n.astype(np.float32),
+            self.prefix + "_click_rate": ((sums["clicks"] + m * self.clicks.sum() / total) / (n + m)).astype(np.float32),
+            self.prefix + "_book_rate": ((sums["bookings"] + m * self.bookings.sum() / total) / (n + m)).astype(np.float32),
+            self.prefix + "_position_mean": position_mean.astype(np.float32)}
+
+    def join(self, df, exclude_self=False):
+        """
+        Add the columns() of the key of every row to a data object, in place.
+
+        Args:
+            df: data object.
+            exclude_self: the labelled rows of df are part of the history,
+                so their own outcomes are subtracted first (leave-one-out).
+        """
+        columns = self.columns(df[self.key].values, self.row_sums(df) if exclude_self else None)
+        for suffix in ["_count", "_click_rate", "_book_rate", "_position_mean"]:
+            df[self.prefix + suffix] = columns[self.prefix + suffix]
+
+    def top_keys(self, statistic="clicks", quantile=0.75):
+        """
+        Keys whose rate of a statistic is above the given quantile.
+        """
+        rate = getattr(self, statistic) / np.maximum(self.count, 1)
+        return self.keys[rate > np.percentile(rate, 100 * quantile)]
+
+def new_indexes():
+    """
+    Empty indexes of every key in INDEX_KEYS.
+    """
+    return dict((prefix, StatsIndex(key, prefix)) for prefix, key in INDEX_KEYS.items())
+
+def join_indexes(df, indexes, exclude_self=False):
+    """
+    Join the statistics of every index to a data object, in place.
+    """
+    for prefix in sorted(indexes):
+        indexes[prefix].join(df, exclude_self)
+
+def save_indexes(indexes, path, sources=()):
+    """
+    Save indexes to a .npz file along with the log files they hold.
+    """
+    arrays = {"sources": np.asarray(list(sources), dtype=str)}
+    for prefix, index in indexes.items():
+        arrays[prefix + "__keys"] = index.keys
+        for name in StatsIndex.SUMS:
+            arrays[prefix + "__" + name] = getattr(index, name)
+    np.savez(path, **arrays)
+
+def load_indexes(path):
+    """
+    Load indexes saved by save_indexes().
+
+    Returns:
+        (dict of StatsIndex, list of log sources).
+    """
+    data = np.load(path)
+    indexes = new_indexes()
+    for prefix, index in indexes.items():
+        index.keys = data[prefix + "__keys"]
+        for name in StatsIndex.SUMS:
+            setattr(index, name, data[prefix + "__" + name])
+    return indexes, [str(s) for s in data["sources"]]
+
+def main():
+    """
+    Build the indexes from train.csv, or merge the logs given as arguments
+    into the saved indexes.
+    """
+    paths = data_import.get_paths()
+    profiling.configure(paths)
+    index_path = paths["stats_index_path"]
+    logs = sys.argv[1:]
+    if logs and os.path.exists(index_path):
+        indexes, sources = load_indexes(index_path)
+    else:
+        indexes, sources = new_indexes(), []
+        logs = logs or [paths["train_path"]]
+
+    for log in logs:
+        source = "{}:{}:{}".format(os.path.abspath(log), *cache.source_key(log))
+        if source in sources:
+            print("Skipping {}, already indexed".format(log))
+            continue
+        print("Indexing {}...".format(log))
+        with profiling.stage("index " + os.path.basename(log)) as span:
+            span.rows = 0
+            for chunk in data_import.read_chunks(log):
+                for index in indexes.values():
+                    index.update(chunk)
+                span.rows += len(chunk)
+        sources.append(source)
+
+    save_indexes(indexes, index_path, sources)
+    for prefix, index in sorted(indexes.items()):
+        print("{}: {} keys, {} rows".format(prefix, len(index.keys), int(index.count.sum())))
+    profiling.save_trace(paths, "stats_index")
+
+if __name__=="__main__":
+    main()
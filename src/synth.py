@@ -0,0 +1,182 @@
+import data_import
+import profiling
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+## the 54 columns of train.csv, in file order
+TRAIN_COLUMNS = ["srch_id", "date_time", "site_id", "visitor_location_country_id",
+    "visitor_hist_starrating", "visitor_hist_adr_usd", "prop_country_id", "prop_id",
+    "prop_starrating", "prop_review_score", "prop_brand_bool", "prop_location_score1",
+    "prop_location_score2", "prop_log_historical_price", "position", "price_usd",
+    "promotion_flag", "srch_destination_id", "srch_length_of_stay", "srch_booking_window",
+    "srch_adults_count", "srch_children_count", "srch_room_count", "srch_saturday_night_bool",
+    "srch_query_affinity_score", "orig_destination_distance", "random_bool"] + \
+    [name for i in range(1, 9) for name in ["comp%d_rate" % i, "comp%d_inv" % i, "comp%d_rate_percent_diff" % i]] + \
+    ["click_bool", "gross_bookings_usd", "booking_bool"]
+
+## test.csv lacks the outcome columns
+TEST_COLUMNS = [name for name in TRAIN_COLUMNS if name not in ["position", "click_bool", "gross_bookings_usd", "booking_bool"]]
+
+## share of missing values of the sparse columns, as in train.csv
+NAN_RATES = {"visitor_hist_starrating": 0.95, "visitor_hist_adr_usd": 0.95, "prop_review_score": 0.0015,
+    "prop_location_score2": 0.22, "srch_query_affinity_score": 0.94, "orig_destination_distance": 0.32}
+COMP_NAN_RATES = [(0.98, 0.98, 0.98), (0.58, 0.56, 0.89), (0.69, 0.67, 0.90), (0.94, 0.93, 0.97),
+    (0.55, 0.52, 0.83), (0.95, 0.95, 0.98), (0.94, 0.93, 0.97), (0.61, 0.60, 0.88)]
+
+class SyntheticExpedia(object):
+    """
+    Generator of Expedia-schema searches at any scale.
+
+    Properties have fixed attributes shared by all their rows, and
+    every search has 5-38 candidate rows sharing the search-level fields.
+    Clicks follow a logistic utility of the property attributes and price
+    (about 4.5% of the rows, 62% of the clicks booked), and 'position'
+    orders the rows by utility unless the search is randomly ordered, so
+    the models have some signal to learn.
+
+    Args:
+        n_props: the number of distinct properties.
+        n_destinations: the number of distinct destinations.
+        random_state: seed of the property table and the searches.
+    """
+    def __init__(self, n_props=140000, n_destinations=20000, random_state=42):
+        self.n_destinations = n_destinations
+        self.rng = np.random.RandomState(random_state)
+        rng = self.rng
+        self.props = pd.DataFrame({
+            "prop_country_id": rng.randint(1, 173, n_props),
+            "prop_starrating": rng.choice(6, n_props, p=[0.03, 0.02, 0.15, 0.42, 0.3, 0.08]),
+            "prop_review_score": np.round(np.clip(rng.normal(3.8, 1.0, n_props), 0, 5) * 2) / 2,
+            "prop_brand_bool": (rng.rand(n_props) < 0.63).astype(int),
+            "prop_location_score1": np.round(rng.gamma(3.0, 1.0, n_props).clip(0, 6.98), 2),
+            "prop_location_score2": np.round(rng.beta(1.2, 8.0, n_props), 4),
+            "prop_log_historical_price": np.where(rng.rand(n_props) < 0.14, 0, np.round(rng.normal(4.3, 0.6, n_props), 2)),
+            "base_price": np.exp(rng.normal(4.7, 0.6, n_props)),
+        })
+        self.next_srch_id = 1
+
+    def searches(self, n_rows, test=False):
+        """
+        Generate searches with about n_rows rows in total.
+
+        Args:
+            n_rows: the number of rows (the last search is cut off at n_rows).
+            test: leave out the outcome columns, like test.csv.
+
+        Returns:
+            data object with the train.csv (or test.csv) columns.
+        """
+        rng = self.rng
+        sizes = rng.randint(5, 39, n_rows // 5 + 1)
+        sizes = sizes[:np.searchsorted(np.cumsum(sizes), n_rows) + 1]
+        sizes[-1] -= sizes.sum() - n_rows
+        n_searches, N = len(sizes), n_rows
+        search = np.repeat(np.arange(n_searches), sizes)
+        def per_search(values):
+            return values[search]
+        def with_nan(values, rate):
+            return np.where(rng.rand(len(values)) < rate, np.nan, values)
+
+        df = pd.DataFrame()
+        df["srch_id"] = per_search(np.arange(self.next_srch_id, self.next_srch_id + n_searches))
+        self.next_srch_id += n_searches
+        start = np.datetime64("2012-11-01T00:00:00")
+        seconds = rng.randint(0, 242 * 24 * 3600, n_searches).astype("timedelta64[s]")
+        df["date_time"] = per_search(pd.to_datetime(start + seconds).strftime(data_import.DATE_FORMAT).values)
+        df["site_id"] = per_search(rng.choice([5, 14, 15, 24, 32], n_searches, p=[0.15, 0.1, 0.05, 0.05, 0.65]))
+        df["visitor_location_country_id"] = per_search(np.where(rng.rand(n_searches) < 0.6, 219, rng.randint(1, 232, n_searches)))
+        has_history = rng.rand(n_searches) >= NAN_RATES["visitor_hist_starrating"]
+        df["visitor_hist_starrating"] = per_search(np.where(has_history, np.round(rng.uniform(1.4, 5, n_searches), 2), np.nan))
+        df["visitor_hist_adr_usd"] = per_search(np.where(has_history, np.round(rng.gamma(2.0, 90.0, n_searches), 2), np.nan))
+
+        prop = rng.randint(0, len(self.props), N)
+        props = self.props.iloc[prop].reset_index(drop=True)
+        df["prop_country_id"] = props["prop_country_id"].values
+        df["prop_id"] = prop + 1
+        for name in ["prop_starrating", "prop_review_score", "prop_brand_bool", "prop_location_score1",
+                "prop_location_score2", "prop_log_historical_price"]:
+            df[name] = props[name].values
+        df["prop_review_score"] = with_nan(df["prop_review_score"].values, NAN_RATES["prop_review_score"])
+        df["prop_location_score2"] = with_nan(df["prop_location_score2"].values, NAN_RATES["prop_location_score2"])
+
+        length_of_stay = per_search(rng.geometric(0.45, n_searches))
+        price = np.round(props["base_price"].values * np.exp(rng.normal(0, 0.25, N)) * np.where(rng.rand(N) < 0.5, 1, length_of_stay), 2)
+        promotion = (rng.rand(N) < 0.22).astype(int)
+        random_bool = per_search((rng.rand(n_searches) < 0.3).astype(int))
+
+        ## utility of every row: location, reviews, stars, promotion and price
+        utility = (0.8 * props["prop_location_score2"].values * 10 + 0.3 * props["prop_review_score"].values
+            + 0.2 * props["prop_starrating"].values + 0.4 * promotion - 0.6 * np.log(price / length_of_stay)
+            + rng.gumbel(0, 1, N))
+        order = np.lexsort((-utility + np.where(random_bool == 1, rng.rand(N) * 100, 0), search))
+        position = np.empty(N, dtype=int)
+        starts = np.r_[0, np.cumsum(sizes)[:-1]]
+        position[order] = np.arange(N) - np.repeat(starts, sizes) + 1
+
+        df["position"] = position
+        df["price_usd"] = price
+        df["promotion_flag"] = promotion
+        df["srch_destination_id"] = per_search(rng.randint(1, self.n_destinations + 1, n_searches))
+        df["srch_length_of_stay"] = length_of_stay
+        df["srch_booking_window"] = per_search(rng.geometric(0.03, n_searches) - 1)
+        df["srch_adults_count"] = per_search(rng.choice([1, 2, 3, 4], n_searches, p=[0.2, 0.65, 0.08, 0.07]))
+        df["srch_children_count"] = per_search(rng.choice([0, 1, 2], n_searches, p=[0.75, 0.15, 0.1]))
+        df["srch_room_count"] = per_search(rng.choice([1, 2], n_searches, p=[0.93, 0.07]))
+        df["srch_saturday_night_bool"] = per_search((rng.rand(n_searches) < 0.5).astype(int))
+        df["srch_query_affinity_score"] = with_nan(np.round(-rng.gamma(2.0, 10.0, N), 4), NAN_RATES["srch_query_affinity_score"])
+        df["orig_destination_distance"] = per_search(with_nan(np.round(rng.gamma(1.0, 1200.0, n_searches), 2), NAN_RATES["orig_destination_distance"]))
+        df["random_bool"] = random_bool
+        for i, (rate_nan, inv_nan, diff_nan) in enumerate(COMP_NAN_RATES, 1):
+            df["comp%d_rate" % i] = with_nan(rng.choice([-1, 0, 1], N, p=[0.05, 0.8, 0.15]).astype(float), rate_nan)
+            df["comp%d_inv" % i] = with_nan(rng.choice([-1, 0, 1], N, p=[0.02, 0.95, 0.03]).astype(float), inv_nan)
+            df["comp%d_rate_percent_diff" % i] = with_nan(np.round(rng.gamma(1.0, 20.0, N)) + 2, diff_nan)
+
+        ## outcomes: the best ranked rows are clicked more often
+        seen = utility - 0.15 * np.where(random_bool == 1, 0, position)
+        click = (rng.rand(N) < 1 / (1 + np.exp(-(seen - np.percentile(seen, 98.2))))).astype(int)
+        booking = click * (rng.rand(N) < 0.62)
+        df["click_bool"] = click
+        df["gross_bookings_usd"] = np.where(booking == 1, np.round(price * rng.uniform(1.0, 1.3, N), 2), np.nan)
+        df["booking_bool"] = booking
+        return df[TEST_COLUMNS if test else TRAIN_COLUMNS]
+
+def write_csv(path, n_rows, test=False, chunk_rows=1000000, random_state=42):
+    """
+    Write a synthetic train.csv/test.csv of n_rows rows in chunks of whole searches.
+    """
+    generator = SyntheticExpedia(random_state=random_state)
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path, "w") as f:
+        for start in range(0, n_rows, chunk_rows):
+            df = generator.searches(min(chunk_rows, n_rows - start), test)
+            df.to_csv(f, index=False, header=start == 0, na_rep="NULL")
+    return path
+
+def synthetic_paths(n_rows, directory=None):
+    """
+    Paths of the synthetic train and test files of a given size.
+    """
+    directory = directory or data_import.get_paths()["synthetic_dir"]
+    return (os.path.join(directory, "train_{}.csv".format(n_rows)),
+        os.path.join(directory, "test_{}.csv".format(n_rows)))
+
+def main():
+    """
+    Write synthetic train/test files of the sizes given as arguments
+    (e.g. 'python synth.py 1e5 1e6 1e7').
+    """
+    sizes = [int(float(arg)) for arg in sys.argv[1:]] or [100000]
+    for n_rows in sizes:
+        train_path, test_path = synthetic_paths(n_rows)
+        print("Generating {} synthetic rows...".format(n_rows))
+        with profiling.stage("generate {}".format(n_rows)) as span:
+            write_csv(train_path, n_rows, test=False, random_state=1)
+            write_csv(test_path, n_rows, test=True, random_state=2)
+            span.rows = 2 * n_rows
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,113 @@
+import evaluate
+import numpy as np
+from sklearn.base import clone
+from sklearn.model_selection import ParameterSampler
+try:
+    from joblib import Parallel, delayed
+except ImportError:
+    from sklearn.externals.joblib import Parallel, delayed
+
+def balanced_indices(y, indices, rng):
+    """
+    Downsample negatives to as many rows as there are positives.
+
+    Args:
+        y: array of 0/1 outcomes.
+        indices: candidate row indices.
+        rng: numpy RandomState.
+
+    Returns:
+        sorted row indices.
+    """
+    positives = indices[y[indices] == 1]
+    negatives = indices[y[indices] == 0]
+    negatives = rng.choice(negatives, min(len(positives), len(negatives)), replace=False)
+    return np.sort(np.r_[positives, negatives])
+
+class FoldData(object):
+    """
+    Cross-validation folds over whole searches, shared by every search.
+
+    The feature matrix is stored once; each fold holds the balanced
+    training rows of the other folds and all rows of its own searches for
+    nDCG validation. Every search also gets a random number in [0, 1), so
+    a budget b trains on the searches below b.
+
+    Args:
+        X: feature matrix.
+        y: array of 0/1 outcomes the classifiers are fitted on.
+        srch_ids: array of search ids.
+        rel: array of relevance grades used for validation.
+        n_splits: the number of folds.
+        random_state: seed of the folds and the downsampling.
+    """
+    def __init__(self, X, y, srch_ids, rel, n_splits=3, random_state=42):
+        self.X, self.y, self.srch_ids, self.rel = X, y, srch_ids, rel
+        rng = np.random.RandomState(random_state)
+        _, search = np.unique(srch_ids, return_inverse=True)
+        n_searches = search.max() + 1 if len(search) else 0
+        fold = (rng.permutation(n_searches) % n_splits)[search]
+        self.search_budget = rng.rand(n_searches)[search]
+        self.folds = []
+        for f in range(n_splits):
+            fit = balanced_indices(y, np.flatnonzero(fold != f), rng)
+            valid = np.flatnonzero(fold == f)
+            self.folds.append((fit, valid))
+
+    def fit_indices(self, fold, budget=1.0):
+        """
+        Training rows of a fold restricted to a budget fraction of searches.
+        """
+        fit = self.folds[fold][0]
+        return fit[self.search_budget[fit] < budget] if budget < 1 else fit
+
+def fold_score(estimator, params, data, fold, budget):
+    """
+    Fit one candidate on a fold and return its validation nDCG@38.
+    """
+    est = clone(estimator).set_params(**params)
+    fit = data.fit_indices(fold, budget)
+    valid = data.folds[fold][1]
+    if len(np.unique(data.y[fit])) < 2:
+        return 0.0
+    est.fit(data.X[fit], data.y[fit])
+    scores = est.predict_proba(data.X[valid])[:,1]
+    return evaluate.ndcg(data.srch_ids[valid], data.rel[valid], scores)
+
+def successive_halving(estimator, param_distributions, data, n_candidates=27, eta=3,
+        min_budget=1/9., n_jobs=1, random_state=42, verbose=True):
+    """
+    Randomized search with successive halving on nDCG@38.
+
+    All candidates are first scored on every fold with a small budget of
+    searches; the best 1/eta are kept and the budget is multiplied by eta,
+    until the full folds are used or one candidate is left.
+
+    Args:
+        estimator: unfitted classifier.
+        param_distributions: dict of parameter lists/distributions.
+        data: FoldData shared by all candidates.
+        n_candidates: the number of sampled candidates.
+        eta: reduction factor between rounds.
+        min_budget: fraction of training searches used in the first round.
+        n_jobs: the number of parallel fits.
+        random_state: seed of the candidate sampling.
+        verbose: print the rounds.
+
+    Returns:
+        (best parameters, best mean nDCG@38).
+    """
+    candidates = list(ParameterSampler(param_distributions, n_candidates, random_state=random_state))
+    budget = min_budget
+    parallel = Parallel(n_jobs=n_jobs)
+    while True:
+        fold_scores = parallel(delayed(fold_score)(estimator, params, data, fold, budget)
+            for params in candidates for fold in range(len(data.folds)))
+        scores = np.asarray(fold_scores).reshape(len(candidates), len(data.folds)).mean(axis=1)
+        order = np.argsort(-scores, kind="mergesort")
+        if verbose:
+            print("{} candidates on {:.0%} of the searches, best nDCG@38 {:.4f}".format(len(candidates), min(budget, 1), scores[order[0]]))
+        if len(candidates) == 1 or budget >= 1:
+            return candidates[order[0]], scores[order[0]]
+        candidates = [candidates[i] for i in order[:int(np.ceil(len(candidates) / float(eta)))]]
+        budget = budget * eta
@@ -0,0 +1,58 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import blend
+import data_import
+
+def write_inputs(directory, n_searches=60, seed=0):
+    """
+    A score file and the matching submission of random searches of 1-40
+    rows, sorted by (srch_id, prop_id) like blend() writes them.
+    """
+    rng = np.random.RandomState(seed)
+    sizes = rng.randint(1, 40, n_searches)
+    srch_ids = np.repeat(np.arange(1, n_searches + 1) * 3, sizes)
+    prop_ids = np.concatenate([np.sort(rng.choice(10000, size, replace=False)) for size in sizes])
+    scores = rng.rand(len(srch_ids))
+    scores_path = os.path.join(directory, "input.scores")
+    with data_import.ScoreWriter(scores_path) as writer:
+        writer.write(srch_ids, prop_ids, scores)
+    submission_path = os.path.join(directory, "input.csv")
+    with data_import.SubmissionWriter(submission_path) as writer:
+        writer.write(srch_ids, prop_ids, scores)
+    return scores_path, submission_path
+
+@pytest.mark.parametrize("chunksize", [1, 7, 50, 100000])
+def test_blend_with_itself_keeps_scores(tmpdir, chunksize):
+    ## chunk boundaries fall inside searches; every search must still be blended whole
+    scores_path, _ = write_inputs(str(tmpdir))
+    output = str(tmpdir.join("blend.scores"))
+    n_rows = blend.blend([scores_path, scores_path], output, method="mean", chunksize=chunksize)
+    expected, blended = data_import.read_scores(scores_path), data_import.read_scores(output)
+    assert n_rows == len(expected)
+    assert np.array_equal(expected, blended)
+
+@pytest.mark.parametrize("method", blend.METHODS)
+@pytest.mark.parametrize("chunksize", [1, 7, 50, 100000])
+def test_blend_with_itself_keeps_submission(tmpdir, method, chunksize):
+    _, submission_path = write_inputs(str(tmpdir))
+    output = str(tmpdir.join("blend.csv"))
+    blend.blend([submission_path, submission_path], output, method=method, chunksize=chunksize)
+    with open(submission_path) as expected, open(output) as blended:
+        assert expected.read() == blended.read()
+
+def test_rank_blend_of_scores_matches_submission(tmpdir):
+    scores_path, submission_path = write_inputs(str(tmpdir))
+    output = str(tmpdir.join("blend.csv"))
+    blend.blend([scores_path, submission_path], output, chunksize=13)
+    with open(submission_path) as expected, open(output) as blended:
+        assert expected.read() == blended.read()
+
+def test_mean_rejects_mixed_inputs(tmpdir):
+    scores_path, submission_path = write_inputs(str(tmpdir))
+    with pytest.raises(ValueError):
+        blend.blend([scores_path, submission_path], str(tmpdir.join("blend.csv")), method="mean")
@@ -0,0 +1,62 @@
+import os
+import sys
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestClassifier, GradientBoostingClassifier, ExtraTreesClassifier, VotingClassifier
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import artifact
+from compiled_model import CompiledEnsemble
+
+def training_data(n_rows=3000, seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.rand(n_rows, 12)
+    ## a few low-cardinality columns, like the bin codes of the transformer
+    X[:,:3] = rng.randint(0, 6, (n_rows, 3))
+    y = (X[:,0] + X[:,3] + 0.5 * rng.rand(n_rows) > 3).astype(int)
+    return X, y
+
+def voting_model(loss):
+    return VotingClassifier(estimators=[
+            ('rf', RandomForestClassifier(n_estimators=15, max_depth=6, random_state=0)),
+            ('gbm', GradientBoostingClassifier(n_estimators=20, max_depth=3, loss=loss, random_state=0)),
+            ('et', ExtraTreesClassifier(n_estimators=15, max_depth=None, random_state=0))],
+        voting='soft', weights=[3,5,2])
+
+@pytest.mark.parametrize("loss", ["exponential", "log_loss"])
+def test_compiled_matches_predict_proba(loss):
+    X, y = training_data()
+    model = voting_model(loss).fit(X, y)
+    compiled = CompiledEnsemble([model], ["model"])
+    X_test = training_data(1000, seed=1)[0]
+    expected = model.predict_proba(X_test)[:,1]
+    for chunksize in [1, 256, 5000]:
+        assert np.allclose(compiled.predict_proba(X_test, chunksize)[:,0], expected, rtol=0, atol=1e-12)
+
+def test_unbounded_depth_is_not_padded():
+    X, y = training_data(5000)
+    forest = RandomForestClassifier(n_estimators=10, max_depth=None, random_state=0).fit(X, y)
+    compiled = CompiledEnsemble([forest], ["forest"])
+    assert len(compiled.feature) == sum(tree.tree_.node_count for tree in forest.estimators_)
+    assert np.allclose(compiled.predict_proba(X)[:,0], forest.predict_proba(X)[:,1], rtol=0, atol=1e-12)
+
+def test_saved_artifact_scores_the_same(tmpdir):
+    X, y = training_data()
+    book, click = voting_model("exponential").fit(X, y), voting_model("exponential").fit(X, 1 - y)
+    compiled = CompiledEnsemble([book, click], ["book", "click"])
+    path = str(tmpdir.join("compiled_model"))
+    compiled.save(path)
+    loaded = CompiledEnsemble.load(path)
+    assert loaded.names == ["book", "click"] and loaded.transformer is None
+    assert np.array_equal(loaded.predict_proba(X), compiled.predict_proba(X))
+
+    ## a corrupt buffer is caught on load, without verify
+    buffer = os.path.join(path, "value.npy")
+    with open(buffer, "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes(bytearray([ord(last) ^ 1])))
+    with pytest.raises(artifact.ArtifactError):
+        CompiledEnsemble.load(path)
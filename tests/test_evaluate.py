@@ -0,0 +1,54 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import evaluate
+
+def brute_force_ndcg(rel, scores, k):
+    """
+    nDCG@k of one search by sorting its rows: higher scores first, ties in
+    row order.
+    """
+    order = sorted(range(len(scores)), key=lambda i: -scores[i])
+    gains = 2.0 ** np.asarray(rel, dtype=float) - 1
+    discounts = 1 / np.log2(np.arange(len(scores)) + 2)
+    dcg = np.sum(gains[order][:k] * discounts[:k])
+    ideal = np.sum(np.sort(gains)[::-1][:k] * discounts[:k])
+    return dcg / ideal if ideal > 0 else 0.0
+
+def random_searches(n_searches, seed, tied):
+    rng = np.random.RandomState(seed)
+    sizes = rng.randint(1, 50, n_searches)
+    srch_ids = np.repeat(rng.choice(100000, n_searches, replace=False), sizes)
+    rel = rng.choice([0, 0, 0, 1, 5], len(srch_ids))
+    ## a few distinct values make most scores tie with another row of their search
+    scores = rng.randint(0, 4, len(srch_ids)).astype(float) if tied else rng.rand(len(srch_ids))
+    return srch_ids, rel, scores
+
+@pytest.mark.parametrize("tied", [False, True])
+@pytest.mark.parametrize("k", [1, 5, 38])
+def test_ndcg_per_search_matches_brute_force(tied, k):
+    srch_ids, rel, scores = random_searches(300, 0, tied)
+    ids, values = evaluate.ndcg_per_search(srch_ids, rel, scores, k, grouped=True)
+    starts, _ = evaluate.search_starts(srch_ids)
+    ends = np.r_[starts[1:], len(srch_ids)]
+    assert np.array_equal(ids, srch_ids[starts])
+    expected = [brute_force_ndcg(rel[a:b], scores[a:b], k) for a, b in zip(starts, ends)]
+    assert np.allclose(values, expected, rtol=0, atol=1e-12)
+
+def test_ndcg_per_search_of_interleaved_searches():
+    srch_ids, rel, scores = random_searches(100, 1, True)
+    ids, values = evaluate.ndcg_per_search(srch_ids, rel, scores, grouped=True)
+    ## interleave the searches, keeping the order of the rows of each one (so ties resolve the same)
+    keys = np.random.RandomState(2).rand(len(srch_ids))
+    starts, _ = evaluate.search_starts(srch_ids)
+    for a, b in zip(starts, np.r_[starts[1:], len(srch_ids)]):
+        keys[a:b] = np.sort(keys[a:b])
+    order = np.argsort(keys)
+    shuffled_ids, shuffled_values = evaluate.ndcg_per_search(srch_ids[order], rel[order], scores[order])
+    lookup = dict(zip(ids, values))
+    assert sorted(shuffled_ids) == sorted(ids)
+    assert np.allclose([lookup[i] for i in shuffled_ids], shuffled_values, rtol=0, atol=1e-12)
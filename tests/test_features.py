@@ -0,0 +1,60 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import data_import
+import synth
+from features import FeatureTransformer, SearchCache
+from stats_index import new_indexes, save_indexes
+
+@pytest.fixture(scope="module")
+def fitted(tmpdir_factory):
+    """
+    A transformer fitted on synthetic training rows, with a stats index
+    and the popular destinations, and synthetic test rows.
+    """
+    directory = tmpdir_factory.mktemp("features")
+    train_path = synth.write_csv(str(directory.join("train.csv")), 4000, random_state=1)
+    test_path = synth.write_csv(str(directory.join("test.csv")), 1500, test=True, random_state=2)
+    train = data_import.read_compact(train_path, chunksize=1000)
+    indexes = new_indexes()
+    for index in indexes.values():
+        index.update(train)
+    stats_path = str(directory.join("stats_index.npz"))
+    save_indexes(indexes, stats_path)
+    transformer = FeatureTransformer(pop_dest=True, stats_path=stats_path)
+    transformer.fit_transform(train)
+    transformer.fit_bins(train)
+    return transformer, data_import.read_compact(test_path, chunksize=1000), test_path
+
+def request_columns(rows):
+    """
+    Column arrays of raw test.csv rows as serve.py builds them: 'date_time'
+    as the strings of the request, the other columns in the compact schema.
+    """
+    columns = {"date_time": rows["date_time"].values}
+    for name, dtype in data_import.DTYPES.items():
+        if name in rows.columns:
+            columns[name] = rows[name].values.astype(dtype)
+    return columns
+
+@pytest.mark.parametrize("use_cache", [False, True])
+def test_request_matrix_matches_transform(fitted, use_cache):
+    transformer, test, test_path = fitted
+    expected = test.copy()
+    transformer.transform(expected)
+    expected = transformer.matrix(expected)
+    raw = pd.read_csv(test_path, na_values="NULL")
+    cache = SearchCache() if use_cache else None
+    starts = np.flatnonzero(np.r_[True, np.diff(raw["srch_id"].values) != 0])
+    ends = np.r_[starts[1:], len(raw)]
+    ## one search per request, as served; twice with the cache so its hits are checked too
+    for _ in range(2 if use_cache else 1):
+        for start, end in zip(starts, ends):
+            X = transformer.request_matrix(request_columns(raw.iloc[start:end]), cache)
+            assert X.dtype == expected.dtype
+            assert np.array_equal(X, expected[start:end])